@@ -4,129 +4,2098 @@ import logging
 import threading
 from datetime import datetime, timedelta
 from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, Update
 from dotenv import load_dotenv
 import os
 import json
 import re
 import atexit
-from flask import Flask
+import logging.handlers
+import time
+import queue
+import sqlite3
+import gzip
+import contextvars
+from collections import deque
+import bisect
+import mmap
+import html
+from array import array
+import signal
+import hmac
+import weakref
+import contextlib
+import operator
+import concurrent.futures
+from collections import OrderedDict
+from abc import ABC, abstractmethod
+from aiohttp import web
+from sortedcontainers import SortedList
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 
-logging.basicConfig(filename='bot.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+LOG_FILE = 'bot.log'
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_BUFFER_SIZE = int(os.getenv('LOG_BUFFER_SIZE', '2000'))  # recent records kept in memory
+# Per-logger sampling of INFO records, e.g. LOG_SAMPLING=balance=0.1 keeps ~10% of balance updates
+LOG_SAMPLING = os.getenv('LOG_SAMPLING', '')
+
+class JsonLinesFormatter(logging.Formatter):
+    """One JSON object per line; structured fields come from logging's extra={...}"""
+    FIELDS = ('event', 'user_id', 'game', 'amount', 'duration')  # duration: ms, on timed events (save, slow_update)
+
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text  # formatted before queueing, see TracebackQueueHandler
+        return json.dumps(entry, ensure_ascii=False)
+
+class TracebackQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that keeps the formatted traceback in exc_text instead of folding it into msg"""
+
+    def prepare(self, record):
+        exc_text = self.formatter.formatException(record.exc_info) if record.exc_info else record.exc_text
+        record = logging.makeLogRecord(dict(record.__dict__, msg=record.getMessage(), args=None,
+                                            exc_info=None, exc_text=exc_text))
+        record.message = record.msg
+        return record
+
+class SamplingFilter(logging.Filter):
+    """Lets through a fraction of records below WARNING; warnings and errors always pass"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+# Rotation: bot.log is closed after LOG_ROTATE_BYTES or LOG_ROTATE_SECONDS and gzip-compressed
+LOG_ROTATE_BYTES = int(os.getenv('LOG_ROTATE_BYTES', str(5 * 1024 * 1024)))
+LOG_ROTATE_SECONDS = int(os.getenv('LOG_ROTATE_SECONDS', '86400'))
+LOG_KEEP_SEGMENTS = int(os.getenv('LOG_KEEP_SEGMENTS', '30'))
+LOG_TS_RE = re.compile(r'(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)')
+
+def log_line_time(line, default=None):
+    """Epoch time of a log line (JSON or plain format); continuation lines get default"""
+    m = LOG_TS_RE.search(line[:40])
+    if m is None:
+        return default
+    try:
+        return datetime.strptime(m.group(1), '%Y-%m-%d %H:%M:%S').timestamp()
+    except ValueError:
+        return default
+
+class SegmentedLogHandler(logging.FileHandler):
+    """Log file rotated by size/age into gzip segments.
+
+    Each segment is a series of gzip members of MEMBER_LINES lines; the sidecar index
+    (<log>.index.json) keeps every member's time range, offset and length, so a time
+    range query only decompresses the members that overlap it. The active file keeps an
+    in-memory list of (time, offset) marks every MEMBER_LINES lines for the same purpose.
+    """
+    MEMBER_LINES = 1000
+
+    def __init__(self, path, max_bytes, max_age, keep):
+        super().__init__(path, encoding='utf-8')
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.keep = keep
+        self.index_path = self.baseFilename + '.index.json'
+        self.directory = os.path.dirname(self.baseFilename)
+        try:
+            with open(self.index_path, 'r') as f:
+                self.segments = json.load(f)['segments']
+        except FileNotFoundError:
+            self.segments = []
+        except (ValueError, KeyError) as e:
+            # Logging isn't configured yet while the handler is built, so report through lastResort
+            logging.lastResort.handle(logging.makeLogRecord({
+                'msg': f'Log index {self.index_path} unreadable, starting a new one: {e}',
+                'levelno': logging.WARNING, 'levelname': 'WARNING',
+            }))
+            self.segments = []
+        self.marks, self.lines_since_mark = self._scan_marks()
+        # An existing file is as old as its first line
+        self.opened_at = self.marks[0][0] if self.marks else time.time()
+
+    def _scan_marks(self):
+        """(time, offset) of the first line and of every MEMBER_LINES-th line of the active file"""
+        marks, count, t = [], 0, None
+        with open(self.baseFilename, 'rb') as f:
+            offset = 0
+            for raw in f:
+                t = log_line_time(raw.decode('utf-8', errors='replace'), t)
+                if t is not None and (not marks or count >= self.MEMBER_LINES):
+                    marks.append((t, offset))
+                    count = 0
+                count += 1
+                offset += len(raw)
+        return marks, count
+
+    def emit(self, record):
+        if self.stream is not None and (not self.marks or self.lines_since_mark >= self.MEMBER_LINES):
+            self.marks.append((record.created, self.stream.tell()))
+            self.lines_since_mark = 0
+        super().emit(record)
+        self.lines_since_mark += 1
+        if self.stream is not None and (self.stream.tell() >= self.max_bytes
+                                        or time.time() - self.opened_at >= self.max_age):
+            try:
+                self.rotate()
+            except Exception:
+                self.handleError(record)
+
+    def rotate(self):
+        """Close the current file, compress it into a segment and start a new one (under the handler lock)"""
+        self.stream.close()
+        self.stream = None
+        closed = f'{self.baseFilename}.{datetime.now():%Y%m%d-%H%M%S-%f}'
+        os.replace(self.baseFilename, closed)
+        self.opened_at = time.time()
+        self.marks, self.lines_since_mark = [], 0
+        self.stream = self._open()
+        segment = self._compress(closed)
+        if segment is not None:
+            self.segments.append(segment)
+        while len(self.segments) > self.keep:
+            old = self.segments.pop(0)
+            try:
+                os.remove(os.path.join(self.directory, old['file']))
+            except FileNotFoundError:
+                pass
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'segments': self.segments}, f)
+        os.replace(tmp, self.index_path)
+
+    def _compress(self, path):
+        gz_path = path + '.gz'
+        members = []  # [first_time, last_time, offset, length]
+        with open(path, 'rb') as src, open(gz_path, 'wb') as dst:
+            chunk, first, last = [], None, None
+            for raw in src:
+                t = log_line_time(raw.decode('utf-8', errors='replace'), last)
+                if t is not None:
+                    first = t if first is None else first
+                    last = t
+                chunk.append(raw)
+                if len(chunk) >= self.MEMBER_LINES:
+                    members.append(self._write_member(dst, chunk, first, last))
+                    chunk, first = [], None
+            if chunk:
+                members.append(self._write_member(dst, chunk, first, last))
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.remove(path)
+        if not members:
+            os.remove(gz_path)
+            return None
+        return {'file': os.path.basename(gz_path), 'start': members[0][0], 'end': members[-1][1], 'members': members}
+
+    @staticmethod
+    def _write_member(dst, chunk, first, last):
+        offset = dst.tell()
+        dst.write(gzip.compress(b''.join(chunk)))
+        first = first if first is not None else (last or 0)
+        return [first, last if last is not None else first, offset, dst.tell() - offset]
+
+    @staticmethod
+    def _select(lines, start, end, t):
+        for line in lines:
+            t = log_line_time(line, t)
+            if t is not None and start <= t <= end:
+                yield line
+
+    def read_range(self, start, end, limit=1000):
+        """Up to the last limit lines logged between epoch times start and end"""
+        with self.lock:
+            segments = list(self.segments)
+            opened_at = self.opened_at
+            marks = list(self.marks)
+        lines = []
+        for seg in segments:
+            if seg['end'] < start or seg['start'] > end:
+                continue
+            with open(os.path.join(self.directory, seg['file']), 'rb') as f:
+                for m_start, m_end, offset, length in seg['members']:
+                    if m_end < start or m_start > end:
+                        continue
+                    f.seek(offset)
+                    text = gzip.decompress(f.read(length)).decode('utf-8', errors='replace')
+                    lines.extend(self._select(text.splitlines(), start, end, m_start))
+        if opened_at <= end:
+            # Seek past the marks that end before start; lines between marks are in time order
+            i = bisect.bisect_left(marks, (start,)) - 1
+            offset = marks[i][1] if i >= 0 else 0
+            with open(self.baseFilename, 'rb') as f:
+                f.seek(offset)
+                t = None
+                for raw in f:
+                    line = raw.decode('utf-8', errors='replace')
+                    t = log_line_time(line, t)
+                    if t is not None and t > end:
+                        break
+                    if t is not None and t >= start:
+                        lines.append(line)
+        return [line.rstrip('\n') for line in lines[-limit:]]
+
+def parse_log_time(text):
+    """'YYYY-mm-dd HH:MM[:SS]' or today's 'HH:MM[:SS]' -> epoch seconds"""
+    text = text.strip()
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M'):
+        try:
+            return datetime.strptime(text, fmt).timestamp()
+        except ValueError:
+            pass
+    for fmt in ('%H:%M:%S', '%H:%M'):
+        try:
+            t = datetime.strptime(text, fmt).time()
+            return datetime.combine(datetime.now().date(), t).timestamp()
+        except ValueError:
+            pass
+    raise ValueError(f'bad time: {text}')
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the last N formatted records in memory for the dashboard and admin panel"""
+
+    def __init__(self, capacity):
+        super().__init__()
+        self.entries = deque(maxlen=capacity)  # (levelno, user_id or None, formatted line)
+        self.counts = {}  # levelname -> records seen since start
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        # emit() runs under self.lock (see Handler.handle); readers take the same lock
+        self.entries.append((record.levelno, getattr(record, 'user_id', None), line))
+        self.counts[record.levelname] = self.counts.get(record.levelname, 0) + 1
+
+    def records(self, level=None, user_id=None, limit=None):
+        """Newest-last formatted lines, optionally only >= level and mentioning user_id"""
+        with self.lock:
+            entries = list(self.entries)
+        if level is not None:
+            entries = [e for e in entries if e[0] >= level]
+        if user_id is not None:
+            pattern = re.compile(rf'\b{user_id}\b')
+            entries = [e for e in entries if e[1] == user_id or (e[1] is None and pattern.search(e[2]))]
+        lines = [e[2] for e in entries]
+        return lines[-limit:] if limit else lines
+
+    def level_counts(self):
+        with self.lock:
+            return dict(self.counts)
+
+ring_buffer = RingBufferHandler(LOG_BUFFER_SIZE)
+ring_buffer.setFormatter(logging.Formatter(LOG_FORMAT))
+
+# Handlers only enqueue records; a listener thread formats them and writes the file
+file_log_handler = SegmentedLogHandler(LOG_FILE, LOG_ROTATE_BYTES, LOG_ROTATE_SECONDS, LOG_KEEP_SEGMENTS)
+file_log_handler.setFormatter(JsonLinesFormatter())
+log_queue = queue.SimpleQueue()
+queue_log_handler = TracebackQueueHandler(log_queue)
+queue_log_handler.setFormatter(logging.Formatter('%(message)s'))  # formatting proper happens in the listener
+logging.basicConfig(level=logging.INFO, handlers=[queue_log_handler])
+log_listener = logging.handlers.QueueListener(log_queue, file_log_handler, ring_buffer, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+for spec in filter(None, (item.strip() for item in LOG_SAMPLING.split(','))):
+    try:
+        name, rate = spec.split('=')
+        logging.getLogger(name.strip()).addFilter(SamplingFilter(float(rate)))
+    except ValueError:
+        logging.error(f'Bad LOG_SAMPLING entry: {spec}')
+
+balance_log = logging.getLogger('balance')
+action_log = logging.getLogger('action')
 
 bot = Bot(token=BOT_TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 
-app = Flask(__name__)
+# Dashboard runs on the bot's event loop: handlers read state between awaits, so every page is consistent
+DASHBOARD_HOST = os.getenv('DASHBOARD_HOST', '0.0.0.0')
+DASHBOARD_PORT = int(os.getenv('DASHBOARD_PORT', '5000'))
+routes = web.RouteTableDef()
+
+def query_int(request, name, default=None):
+    try:
+        return int(request.query[name])
+    except (KeyError, ValueError):
+        return default
+
+def html_page(body):
+    return web.Response(text=body, content_type='text/html')
 
-@app.route('/')
-def dashboard():
-    global balances, stats, paused, pending_duels
-    user_count = len(balances)
-    active_duels = len([d for d in pending_duels.values() if isinstance(d, dict) and 'scores' in d])
+@routes.get('/')
+async def dashboard(request):
+    agg = aggregates.snapshot()
     rtp = (stats['total_wins'] / stats['total_bets'] * 100) if stats['total_bets'] > 0 else 0
-    return f"""
+    flush = persistence.summary()
+    lookups = chat_lookup.summary()
+    slowest = ''.join(f'<tr><td>{html.escape(name)}</td><td>{count}</td><td>{avg:.1f}</td><td>{peak:.1f}</td><td>{slow}</td></tr>'
+                      for name, count, avg, peak, slow in handler_timings.slowest())
+    return html_page(f"""
     <html>
     <head><title>Dep-Kazino Dashboard</title></head>
     <body>
         <h1>🚀 Bot Status</h1>
-        <p>👥 Active Users: {user_count}</p>
+        <p>👥 Active Users: {agg['users']}</p>
+        <p>💵 Total Balance: ${agg['total']:,} (max ${agg['max']:,}, above start: {agg['above_start']})</p>
+        <p>📊 Balances: {', '.join(f'{label}: {n}' for label, n in agg['histogram'])}</p>
         <p>💰 Total Bets: ${stats['total_bets']:,}</p>
         <p>🏆 Total Wins: ${stats['total_wins']:,}</p>
         <p>📈 RTP: {rtp:.1f}%</p>
-        <p>⚔️ Active Duels: {active_duels}</p>
+        <p>⚔️ Active Duels: {agg['active_duels']}</p>
         <p>⏸️ Paused: {'Yes' if paused else 'No'}</p>
+        <p>💾 Flushes: {flush['flushes']} (last {flush['last_ms']:.1f} ms, avg {flush['avg_ms']:.1f} ms, max {flush['max_ms']:.1f} ms), coalesced ops: {flush['coalesced_ops']}, failed: {flush['failed']}, idle skips: {flush['skipped_idle']}, dirty: {', '.join(flush['dirty']) or '-'}</p>
+        <p>🔎 @username lookups: {lookups['hits']} hits, {lookups['misses']} misses, {lookups['coalesced']} coalesced ({lookups['hit_rate']:.1f}% hit rate), cached: {lookups['size']}</p>
+        <h2>Slowest Handlers</h2>
+        <table border="1" cellpadding="4">
+            <tr><th>Handler</th><th>Updates</th><th>Avg ms</th><th>Max ms</th><th>Slow (&ge;{SLOW_UPDATE_MS:.0f} ms)</th></tr>
+            {slowest or '<tr><td colspan="5">No updates yet</td></tr>'}
+        </table>
         <hr>
         <h2>Recent Logs</h2>
+        <p>{' | '.join(f'{name}: {n}' for name, n in ring_buffer.level_counts().items()) or 'No records yet'} (<a href="/logs?level=WARNING">warnings+</a>)</p>
         <pre>{get_recent_logs()}</pre>
         <p><small>Updated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</small></p>
     </body>
     </html>
-    """
+    """)
+
+LOG_PAGE_SIZE = 100
+
+class LogReader:
+    """Reads the log without loading it whole, through a line-offset index for pages"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()  # /logs pages are read from worker threads
+        self.offsets = array('Q')  # byte offset where each complete line starts
+        self.indexed = 0  # bytes covered by the index (end of the last complete line)
+        self.inode = None
+
+    def _refresh(self):
+        """Extend the index over lines appended since the last call, via mmap"""
+        st = os.stat(self.path)
+        if st.st_ino != self.inode or st.st_size < self.indexed:
+            # Rotated or truncated: start over
+            self.offsets = array('Q')
+            self.indexed = 0
+            self.inode = st.st_ino
+        if st.st_size <= self.indexed:
+            return
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = mm.find(b'\n', self.indexed)
+            while pos != -1:
+                self.offsets.append(self.indexed)
+                self.indexed = pos + 1
+                pos = mm.find(b'\n', self.indexed)
+
+    def page(self, before=None, size=LOG_PAGE_SIZE):
+        """Up to size lines ending just before line number before (default: the end).
+
+        Returns (lines, first_line_number, total_lines).
+        """
+        with self.lock:
+            try:
+                self._refresh()
+            except FileNotFoundError:
+                return [], 0, 0
+            total = len(self.offsets)
+            end = total if before is None else max(0, min(before, total))
+            start = max(0, end - size)
+            if start == end:
+                return [], start, total
+            begin = self.offsets[start]
+            stop = self.offsets[end] if end < total else self.indexed
+        with open(self.path, 'rb') as f:
+            f.seek(begin)
+            chunk = f.read(stop - begin)
+        return chunk.decode('utf-8', errors='replace').splitlines(), start, total
+
+log_reader = LogReader(LOG_FILE)
 
 def get_recent_logs():
+    lines = ring_buffer.records(limit=20)
+    return html.escape('\n'.join(lines)) if lines else "No logs available."
+
+@routes.get('/logs')
+async def full_logs(request):
+    # /logs[?level=WARNING&user=ID] serves the in-memory buffer; page/before page through bot.log:
+    # /logs?page=N counts pages back from the newest, /logs?before=L ends the page just before line L;
+    # /logs?from=14:00&to=14:05 reads a time range across rotated segments
     try:
-        with open('bot.log', 'r') as f:
-            lines = f.readlines()
-            return ''.join(lines[-20:])  # Last 20 lines
-    except:
-        return "No logs available."
-
-@app.route('/logs')
-def full_logs():
-    try:
-        with open('bot.log', 'r') as f:
-            return f'<pre>{f.read()}</pre>'
-    except:
-        return 'Logs not found.'
+        args = request.query
+        if 'from' in args:
+            start = parse_log_time(args['from'])
+            end = parse_log_time(args['to']) if 'to' in args else time.time()
+            lines = await asyncio.to_thread(file_log_handler.read_range, start, end)
+            return html_page(f'<p>{len(lines)} lines from {html.escape(args["from"])} to {html.escape(args.get("to", "now"))}</p>'
+                             f'<pre>{html.escape(chr(10).join(lines))}</pre>')
+        if 'page' not in args and 'before' not in args:
+            level_name = args.get('level', '').upper()
+            level = logging.getLevelName(level_name) if level_name else None
+            if not isinstance(level, int):
+                level = None
+            lines = ring_buffer.records(level, query_int(request, 'user'))
+            return html_page(f'<p>Last {len(lines)} buffered records | <a href="/logs?page=0">Log file</a></p>'
+                             f'<pre>{html.escape(chr(10).join(lines))}</pre>')
+        size = LOG_PAGE_SIZE
+        before = query_int(request, 'before')
+        if before is None:
+            page = max(0, query_int(request, 'page', 0))
+            total = (await asyncio.to_thread(log_reader.page, None, 0))[2]
+            before = total - page * size
+        lines, start, total = await asyncio.to_thread(log_reader.page, before, size)
+        end = start + len(lines)
+        nav = []
+        if start > 0:
+            nav.append(f'<a href="/logs?before={start}">← Older</a>')
+        if end < total:
+            nav.append(f'<a href="/logs?before={min(total, end + size)}">Newer →</a>')
+        return html_page(f'<p>Lines {start + 1}-{end} of {total} {" | ".join(nav)}</p>'
+                         f'<pre>{html.escape(chr(10).join(lines))}</pre>')
+    except Exception as e:
+        logging.error(f'Error serving logs: {e}')
+        return web.Response(text='Logs not found.')
+
+# Prometheus-style metrics: label children and histogram buckets are allocated once per label set
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"')) for n, v in zip(names, values))
+    return '{' + pairs + '}'
+
+class CounterMetric:
+    kind = 'counter'
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        self.values = {}  # label values tuple -> count
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in list(self.values.items()):
+            yield self.name, format_labels(self.labelnames, labels), value
+
+class GaugeMetric:
+    """Value read at scrape time from fn(): a number, or {label values tuple: number}"""
+    kind = 'gauge'
+
+    def __init__(self, name, doc, fn, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.fn = fn
+        self.labelnames = labelnames
+
+    def samples(self):
+        value = self.fn()
+        if isinstance(value, dict):
+            for labels, v in value.items():
+                yield self.name, format_labels(self.labelnames, labels), v
+        else:
+            yield self.name, '', value
+
+class HistogramMetric:
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.children = {}  # label values tuple -> [bucket counts (+Inf last), sum, count]
+
+    def observe(self, value, *labels):
+        child = self.children.get(labels)
+        if child is None:
+            child = self.children[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        child[0][bisect.bisect_left(self.buckets, value)] += 1
+        child[1] += value
+        child[2] += 1
+
+    def samples(self):
+        for labels, (counts, total, count) in list(self.children.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                yield f'{self.name}_bucket', format_labels(self.labelnames + ('le',), labels + (bound,)), cumulative
+            yield f'{self.name}_sum', format_labels(self.labelnames, labels), total
+            yield f'{self.name}_count', format_labels(self.labelnames, labels), count
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        out = []
+        for metric in self.metrics:
+            out.append(f'# HELP {metric.name} {metric.doc}')
+            out.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                out.append(f'{name}{labels} {value}')
+        return '\n'.join(out) + '\n'
+
+metrics = MetricsRegistry()
+updates_total = metrics.register(CounterMetric('depbot_updates_total', 'Updates received', ('type',)))
+handler_latency = metrics.register(HistogramMetric('depbot_handler_seconds', 'Handler latency', ('game', 'handler')))
+handler_errors = metrics.register(CounterMetric('depbot_handler_errors_total', 'Handler exceptions', ('game', 'handler')))
+api_latency = metrics.register(HistogramMetric('depbot_api_seconds', 'Telegram Bot API call latency', ('method',)))
+api_errors = metrics.register(CounterMetric('depbot_api_errors_total', 'Telegram Bot API errors', ('method', 'error')))
+flush_latency = metrics.register(HistogramMetric('depbot_flush_seconds', 'Persistence flush duration (successful flushes)'))
+flushes_total = metrics.register(CounterMetric('depbot_flushes_total', 'Persistence flushes', ('status',)))
+save_latency = metrics.register(HistogramMetric('depbot_save_seconds', 'Snapshot write duration (worker thread)'))
+loop_lag = metrics.register(HistogramMetric('depbot_loop_lag_seconds', 'Event loop scheduling lag'))
+metrics.register(GaugeMetric('depbot_queue_size', 'Items waiting in in-memory queues', lambda: {
+    ('random_queue',): len(matchmaker),
+    ('pending_duels',): len(pending_duels),
+    ('log_records',): log_queue.qsize(),
+    ('ledger_records',): storage_backend.backlog(),
+    **outbound.queue_sizes(),
+}, ('queue',)))
+metrics.register(GaugeMetric('depbot_active_duels', 'Duels in progress', lambda: len(aggregates.active_duels)))
+metrics.register(GaugeMetric('depbot_users', 'Registered users', lambda: len(users)))
+LOOP_LAG_INTERVAL = 0.5
+
+async def watch_loop_lag(interval=LOOP_LAG_INTERVAL):
+    """Sleep for interval and record how late the loop woke us up"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        loop_lag.observe(max(0.0, loop.time() - started - interval))
+
+@routes.get('/metrics')
+async def metrics_page(request):
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+app = web.Application()
+app.add_routes(routes)
 
 bot = Bot(token=BOT_TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 
-balances = {}
-user_info = {}
-banned_users = set()
+GAME_LABELS = ('slots', 'roulette', 'blackjack', 'poker', 'sport', 'duel', 'bonus', 'admin', 'feedback', 'pm')
+handler_label_cache = {}  # handler callback -> (game, handler name)
+
+def handler_labels(data):
+    handler = data.get('handler')
+    callback = handler.callback if handler is not None else None
+    labels = handler_label_cache.get(callback)
+    if labels is None:
+        name = getattr(callback, '__name__', 'unknown')
+        game = next((g for g in GAME_LABELS if g in name), 'other')
+        labels = handler_label_cache[callback] = (game, name)
+    return labels
+
+# Per-update tracing: wall time, time awaiting the Bot API and time in persistence for each update
+SLOW_UPDATE_MS = float(os.getenv('SLOW_UPDATE_MS', '500'))
+slow_log = logging.getLogger('slow')
+
+class UpdateTrace:
+    __slots__ = ('handler', 'api_time', 'api_calls', 'persist_time')
+
+    def __init__(self):
+        self.handler = None
+        self.api_time = 0.0
+        self.api_calls = {}  # method -> [calls, seconds]
+        self.persist_time = 0.0
+
+    def add_api_call(self, method, elapsed):
+        self.api_time += elapsed
+        entry = self.api_calls.get(method)
+        if entry is None:
+            self.api_calls[method] = [1, elapsed]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def breakdown(self):
+        calls = ', '.join(f'{m} x{n} {t * 1000:.0f}ms' for m, (n, t) in self.api_calls.items())
+        return f'api {self.api_time * 1000:.0f}ms ({calls or "none"}), persist {self.persist_time * 1000:.1f}ms'
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+class HandlerTimings:
+    """Per-handler count/total/max wall time and slow-update count for the dashboard"""
+
+    def __init__(self):
+        self.by_handler = {}  # handler name -> [count, total seconds, max seconds, slow count]
+
+    def record(self, name, elapsed, slow):
+        entry = self.by_handler.get(name)
+        if entry is None:
+            entry = self.by_handler[name] = [0, 0.0, 0.0, 0]
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] = max(entry[2], elapsed)
+        entry[3] += slow
+
+    def slowest(self, n=10):
+        """[(handler, count, avg_ms, max_ms, slow)] sorted by max wall time"""
+        rows = sorted(self.by_handler.items(), key=lambda item: item[1][2], reverse=True)[:n]
+        return [(name, c, total / c * 1000, peak * 1000, slow) for name, (c, total, peak, slow) in rows]
+
+handler_timings = HandlerTimings()
+
+async def trace_middleware(handler, event, data):
+    trace = UpdateTrace()
+    token = current_trace.set(trace)
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    finally:
+        elapsed = time.perf_counter() - started
+        current_trace.reset(token)
+        name = trace.handler or event.event_type
+        slow = elapsed * 1000 >= SLOW_UPDATE_MS
+        handler_timings.record(name, elapsed, slow)
+        if slow:
+            slow_log.warning(f'Slow update {event.update_id} in {name}: {elapsed * 1000:.0f}ms, {trace.breakdown()}',
+                             extra={'event': 'slow_update', 'duration': round(elapsed * 1000, 1)})
+
+async def handler_metrics_middleware(handler, event, data):
+    labels = handler_labels(data)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.handler = labels[1]
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        handler_errors.inc(*labels)
+        raise
+    finally:
+        handler_latency.observe(time.perf_counter() - started, *labels)
+
+async def update_metrics_middleware(handler, event, data):
+    updates_total.inc(event.event_type)
+    return await handler(event, data)
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Latency and errors of every Bot API call, by method"""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            api_errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            api_latency.observe(elapsed, name)
+            trace = current_trace.get()
+            if trace is not None:
+                trace.add_api_call(name, elapsed)
+
+# Update scheduler: different users run in parallel up to UPDATE_CONCURRENCY, one user's updates
+# (including duels they play in) run strictly in arrival order, and intake blocks once UPDATE_MAX_PENDING are queued
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '32'))
+UPDATE_MAX_PENDING = int(os.getenv('UPDATE_MAX_PENDING', '1000'))
+update_wait = metrics.register(HistogramMetric('depbot_update_wait_seconds', 'Time an update waited in the scheduler'))
+
+class UpdateScheduler:
+    """Update middleware that defers the rest of the chain to per-key worker tasks.
+
+    It runs after aiogram's own outer middlewares (user context, FSM), ahead of ours.
+    Each key with queued updates has one worker draining its deque, so updates for a key
+    never overlap. Every update also holds the user_locks of the users it touches (both
+    players for duel callbacks), so a duel turn never overlaps either player's own
+    updates. A semaphore caps how many run at once. When max_pending updates are queued,
+    intake waits, which stalls getUpdates or the webhook request.
+    """
+
+    def __init__(self, concurrency, max_pending):
+        self.slots = asyncio.Semaphore(concurrency)
+        self.max_pending = max_pending
+        self.queues = {}  # key -> deque of (handler, update, data, user_ids, queued_at); present while a worker runs
+        self.pending = 0
+        self.running = 0
+        self.room = asyncio.Event()
+        self.room.set()
+        self.tasks = set()
+
+    @staticmethod
+    def key_for(update):
+        """(queue key, user ids to lock): duel callbacks queue per duel and lock both players"""
+        user = getattr(update.event, 'from_user', None)
+        callback = update.callback_query
+        if callback is not None and callback.data:
+            players = None
+            if callback.data.startswith('duel_turn_'):
+                players = callback.data.split('_')[2:4]
+            elif callback.data.startswith('accept_duel_'):
+                players = callback.data.split('_')[2:4]
+            if players and len(players) == 2 and all(p.isdigit() for p in players):
+                a, b = sorted(int(p) for p in players)
+                return f'duel:{a}_{b}', {a, b, user.id}
+        if user is not None:
+            return f'user:{user.id}', (user.id,)
+        return f'update:{update.update_id}', ()  # no user: no ordering to keep
+
+    def sizes(self):
+        return {('pending',): self.pending, ('running',): self.running, ('keys',): len(self.queues)}
+
+    async def __call__(self, handler, event, data):
+        while self.pending >= self.max_pending:
+            self.room.clear()
+            await self.room.wait()
+        self.pending += 1
+        key, user_ids = self.key_for(event)
+        q = self.queues.get(key)
+        item = (handler, event, data, user_ids, time.monotonic())
+        if q is not None:
+            q.append(item)
+            return None
+        self.queues[key] = deque((item,))
+        task = asyncio.create_task(self._drain(key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return None
+
+    async def _drain(self, key):
+        q = self.queues[key]
+        try:
+            while q:
+                handler, update, data, user_ids, queued_at = q[0]
+                # Users first, then a slot: waiting on a busy user must not tie up a slot
+                async with user_locks.hold(*user_ids), self.slots:
+                    update_wait.observe(time.monotonic() - queued_at)
+                    self.running += 1
+                    try:
+                        state = data.get('state')
+                        if state is not None:
+                            # raw_state was read at intake; an earlier update of this user may have changed it
+                            data['raw_state'] = await state.get_state()
+                        await handler(update, data)
+                    except Exception as e:
+                        logging.error(f'Error processing update {update.update_id} ({key}): {e}')
+                    finally:
+                        self.running -= 1
+                q.popleft()
+                self.pending -= 1
+                if self.pending < self.max_pending:
+                    self.room.set()
+        finally:
+            del self.queues[key]
+
+    async def drain(self, timeout=10):
+        """Wait for queued updates before shutting down"""
+        if self.tasks:
+            await asyncio.wait(list(self.tasks), timeout=timeout)
+
+update_scheduler = UpdateScheduler(UPDATE_CONCURRENCY, UPDATE_MAX_PENDING)
+metrics.register(GaugeMetric('depbot_update_queue', 'Updates in the scheduler', update_scheduler.sizes, ('state',)))
+
+# Duplicate taps and redelivered callback queries are dropped at intake, before they queue up
+CALLBACK_DEDUP_TTL = float(os.getenv('CALLBACK_DEDUP_TTL', '1.5'))  # seconds a finished tap still suppresses identical taps
+CALLBACK_ID_TTL = 300  # how long a query id is remembered against redelivery
+CALLBACK_IN_FLIGHT_TIMEOUT = 60  # an in-flight mark older than this is treated as lost
+callback_duplicates = metrics.register(CounterMetric('depbot_callback_duplicates_total', 'Duplicate callback queries dropped', ('reason',)))
+
+class CallbackDeduplicator:
+    """Tracks callback queries by id and by tap (user, data, message).
+
+    A tap is a duplicate while an identical one is queued or running, and for ttl
+    seconds after it finished. Duplicates get a bare answer so the button stops
+    spinning; redelivered query ids are dropped silently.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.seen_ids = OrderedDict()  # query id -> arrival time, oldest first
+        self.in_flight = {}  # tap -> arrival time
+        self.recent = OrderedDict()  # tap -> finish time, oldest first
+
+    @staticmethod
+    def tap_key(callback):
+        message_id = callback.message.message_id if callback.message is not None else callback.inline_message_id
+        return (callback.from_user.id, callback.data, message_id)
+
+    def _prune(self, now):
+        while self.seen_ids and next(iter(self.seen_ids.values())) < now - CALLBACK_ID_TTL:
+            self.seen_ids.popitem(last=False)
+        while self.recent and next(iter(self.recent.values())) < now - self.ttl:
+            self.recent.popitem(last=False)
+
+    def check(self, callback):
+        """None for a new tap (now marked in flight), else why it is a duplicate"""
+        now = time.monotonic()
+        self._prune(now)
+        if callback.id in self.seen_ids:
+            return 'query_id'
+        self.seen_ids[callback.id] = now
+        key = self.tap_key(callback)
+        started = self.in_flight.get(key)
+        if started is not None and now - started < CALLBACK_IN_FLIGHT_TIMEOUT:
+            return 'in_flight'
+        if key in self.recent:
+            return 'recent'
+        self.in_flight[key] = now
+        return None
+
+    def finish(self, callback):
+        key = self.tap_key(callback)
+        self.in_flight.pop(key, None)
+        self.recent.pop(key, None)
+        self.recent[key] = time.monotonic()
+
+    async def intake_middleware(self, handler, event, data):
+        callback = event.callback_query
+        if callback is not None:
+            reason = self.check(callback)
+            if reason is not None:
+                callback_duplicates.inc(reason)
+                if reason != 'query_id':
+                    outbound.post(bot.answer_callback_query(callback.id), PRIORITY_INTERACTIVE)
+                return None
+        return await handler(event, data)
+
+    async def finish_middleware(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            self.finish(event)
+
+callback_dedup = CallbackDeduplicator(CALLBACK_DEDUP_TTL)
+
+# Registered ahead of our other middlewares (aiogram's FSM middleware still runs first),
+# so metrics and tracing below measure processing, not queueing
+dp.update.outer_middleware(callback_dedup.intake_middleware)
+dp.update.outer_middleware(update_scheduler)
+dp.callback_query.outer_middleware(callback_dedup.finish_middleware)
+dp.update.outer_middleware(update_metrics_middleware)
+dp.update.outer_middleware(trace_middleware)
+dp.message.middleware(handler_metrics_middleware)
+dp.callback_query.middleware(handler_metrics_middleware)
+
+# Spin animations: a central scheduler paces message edits with per-chat and global token buckets
+ANIMATION_CHAT_RATE = float(os.getenv('ANIMATION_CHAT_RATE', '1'))  # edits per second in one chat
+ANIMATION_CHAT_BURST = float(os.getenv('ANIMATION_CHAT_BURST', '3'))
+ANIMATION_GLOBAL_RATE = float(os.getenv('ANIMATION_GLOBAL_RATE', '20'))  # edits per second for the whole bot
+animation_frames = metrics.register(CounterMetric('depbot_animation_frames_total', 'Animation frames by outcome', ('result',)))
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self):
+        self._refill()
+        return self.tokens >= 1
+
+    def take(self):
+        self.tokens -= 1
+
+    def delay(self):
+        """Seconds until a token is available"""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def penalize(self, seconds):
+        """Flood wait from Telegram: no tokens for the next seconds"""
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+class ChatBuckets:
+    """Per-chat TokenBuckets made on demand by new_bucket(chat_id), at most MAX_CHAT_BUCKETS of them"""
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, new_bucket):
+        self.new_bucket = new_bucket
+        self.buckets = {}
+
+    def get(self, chat_id):
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            if len(self.buckets) >= self.MAX_CHAT_BUCKETS:
+                # Full buckets carry no state worth keeping
+                for key in [k for k, b in self.buckets.items() if b.ready() and b.tokens >= b.capacity]:
+                    del self.buckets[key]
+            bucket = self.buckets[chat_id] = self.new_bucket(chat_id)
+        return bucket
+
+class AnimationScheduler:
+    """Runs spin animations in background tasks so handlers return right away.
+
+    Intermediate frames are dropped when the chat or the bot is out of edit budget
+    (the next frame supersedes them anyway); the final frame always waits for a token.
+    """
+
+    def __init__(self, chat_rate, chat_burst, global_rate):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = ChatBuckets(lambda chat_id: TokenBucket(self.chat_rate, self.chat_burst))
+        self.tasks = set()
+
+    def _try_take(self, bucket):
+        if bucket.ready() and self.global_bucket.ready():
+            bucket.take()
+            self.global_bucket.take()
+            return True
+        return False
+
+    def animate(self, msg, frames, interval, final_text, after=None):
+        """Show frames on msg about interval apart, then final_text, then await after()"""
+        task = asyncio.create_task(self._run(msg, frames, interval, final_text, after))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def _run(self, msg, frames, interval, final_text, after):
+        bucket = self.chat_buckets.get(msg.chat.id)
+        last = None
+        for frame in frames:
+            if frame != last and frame != final_text and self._try_take(bucket):
+                try:
+                    await msg.edit_text(frame)
+                    last = frame
+                    animation_frames.inc('sent')
+                except TelegramRetryAfter as e:
+                    bucket.penalize(e.retry_after)
+                    animation_frames.inc('flood_wait')
+                    break  # skip the rest of the spin, go straight to the result
+                except TelegramBadRequest:
+                    animation_frames.inc('failed')
+                except Exception as e:
+                    # Network/server errors: stop spinning, the result frame and menu must still go out
+                    animation_frames.inc('failed')
+                    logging.error(f'Error editing animation frame in chat {msg.chat.id}: {e}')
+                    break
+            else:
+                animation_frames.inc('dropped')
+            await asyncio.sleep(interval)
+        for _ in range(5):
+            while not self._try_take(bucket):
+                await asyncio.sleep(max(bucket.delay(), self.global_bucket.delay(), 0.01))
+            try:
+                await msg.edit_text(final_text)
+                animation_frames.inc('final')
+                break
+            except TelegramRetryAfter as e:
+                bucket.penalize(e.retry_after)
+                animation_frames.inc('flood_wait')
+            except Exception as e:
+                logging.error(f'Error editing animation result in chat {msg.chat.id}: {e}')
+                break
+        if after is not None:
+            outbound_priority.set(PRIORITY_MENU)  # this task's own context: only the follow-up menu
+            try:
+                await after()
+            except Exception as e:
+                logging.error(f'Error after animation in chat {msg.chat.id}: {e}')
+
+animations = AnimationScheduler(ANIMATION_CHAT_RATE, ANIMATION_CHAT_BURST, ANIMATION_GLOBAL_RATE)
+
+# Outbound sends: one dispatcher orders every new message by priority class and paces it
+# with per-chat and global token buckets. Edits and callback answers are not queued.
+OUTBOUND_CLASSES = ('interactive', 'menu', 'announce', 'bulk')
+PRIORITY_INTERACTIVE, PRIORITY_MENU, PRIORITY_ANNOUNCE, PRIORITY_BULK = range(len(OUTBOUND_CLASSES))
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))  # messages per second for the whole bot
+OUTBOUND_PRIVATE_RATE = float(os.getenv('OUTBOUND_PRIVATE_RATE', '1'))
+OUTBOUND_PRIVATE_BURST = float(os.getenv('OUTBOUND_PRIVATE_BURST', '5'))
+OUTBOUND_GROUP_RATE = float(os.getenv('OUTBOUND_GROUP_RATE', '1'))  # Telegram allows ~1 msg/s in a group
+OUTBOUND_GROUP_BURST = float(os.getenv('OUTBOUND_GROUP_BURST', '2'))
+OUTBOUND_MAX_PENDING = int(os.getenv('OUTBOUND_MAX_PENDING', '1000'))
+OUTBOUND_METHODS = frozenset(('SendMessage', 'SendPhoto', 'SendDocument', 'SendSticker', 'SendDice',
+                              'SendAnimation', 'CopyMessage', 'ForwardMessage'))
+outbound_granted = metrics.register(CounterMetric('depbot_outbound_sent_total', 'Sends released by the outbound dispatcher', ('class',)))
+outbound_dropped = metrics.register(CounterMetric('depbot_outbound_dropped_total', 'Sends abandoned while queued', ('class',)))
+outbound_wait = metrics.register(HistogramMetric('depbot_outbound_wait_seconds', 'Time a send waited in the outbound queue', ('class',)))
+outbound_priority = contextvars.ContextVar('outbound_priority', default=None)
+
+class OutboundDispatcher:
+    """Releases queued sends highest class first, keeping per-chat order.
+
+    Callers wait in acquire() for their turn and then make the request themselves, so
+    per-update tracing and error handling stay in the caller. When more than max_pending
+    sends are queued, everything except interactive replies waits for room.
+    """
+    SCAN_WINDOW = 64  # queued sends looked at per class when the head chats are rate limited
+
+    def __init__(self, global_rate, max_pending):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.max_pending = max_pending
+        self.queues = [deque() for _ in OUTBOUND_CLASSES]  # (chat_id, future, queued_at)
+        self.chat_buckets = ChatBuckets(self._new_bucket)
+        self.pending = 0
+        self.running = False
+        self.wakeup = asyncio.Event()
+        self.room = asyncio.Event()
+        self.room.set()
+        self.tasks = set()
+
+    @staticmethod
+    def is_group(chat_id):
+        return not isinstance(chat_id, int) or chat_id < 0
+
+    def _new_bucket(self, chat_id):
+        if self.is_group(chat_id):
+            return TokenBucket(OUTBOUND_GROUP_RATE, OUTBOUND_GROUP_BURST)
+        return TokenBucket(OUTBOUND_PRIVATE_RATE, OUTBOUND_PRIVATE_BURST)
+
+    def classify(self, chat_id):
+        priority = outbound_priority.get()
+        if priority is None:
+            priority = PRIORITY_ANNOUNCE if self.is_group(chat_id) else PRIORITY_INTERACTIVE
+        return priority
+
+    def queue_sizes(self):
+        return {('outbound_' + name,): len(q) for name, q in zip(OUTBOUND_CLASSES, self.queues)}
+
+    async def acquire(self, chat_id, priority=None):
+        """Wait until a message to chat_id may be sent"""
+        if not self.running:
+            return  # dispatcher not started (startup, scripts): send unpaced
+        if priority is None:
+            priority = self.classify(chat_id)
+        while priority != PRIORITY_INTERACTIVE and self.pending >= self.max_pending:
+            self.room.clear()
+            await self.room.wait()
+        future = asyncio.get_running_loop().create_future()
+        self.queues[priority].append((chat_id, future, time.monotonic()))
+        self.pending += 1
+        self.wakeup.set()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if not future.done() or future.cancelled():
+                outbound_dropped.inc(OUTBOUND_CLASSES[priority])
+            raise
+
+    def penalize(self, chat_id, seconds):
+        self.chat_buckets.get(chat_id).penalize(seconds)
+
+    def post(self, coro, priority):
+        """Fire-and-forget: run coro (which sends) in a background task under the given class"""
+        async def runner():
+            outbound_priority.set(priority)
+            try:
+                await coro
+            except Exception as e:
+                logging.error(f'Error in queued {OUTBOUND_CLASSES[priority]} send: {e}')
+        task = asyncio.create_task(runner())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def _dequeued(self):
+        self.pending -= 1
+        if self.pending < self.max_pending:
+            self.room.set()
+
+    def _release_one(self):
+        """Release the first eligible send; returns 0 after a release, else seconds to wait (None = idle)"""
+        if not self.pending:
+            return None
+        if not self.global_bucket.ready():
+            return self.global_bucket.delay()
+        limited = set()  # chats already passed over: later sends to them must keep waiting
+        delay = None
+        for priority, q in enumerate(self.queues):
+            i = 0
+            while i < len(q) and i < self.SCAN_WINDOW:
+                chat_id, future, queued_at = q[i]
+                if future.done():  # caller gave up
+                    del q[i]
+                    self._dequeued()
+                    continue
+                if chat_id not in limited:
+                    bucket = self.chat_buckets.get(chat_id)
+                    if bucket.ready():
+                        del q[i]
+                        self._dequeued()
+                        bucket.take()
+                        self.global_bucket.take()
+                        outbound_granted.inc(OUTBOUND_CLASSES[priority])
+                        outbound_wait.observe(time.monotonic() - queued_at, OUTBOUND_CLASSES[priority])
+                        future.set_result(None)
+                        return 0
+                    limited.add(chat_id)
+                    wait = bucket.delay()
+                    delay = wait if delay is None else min(delay, wait)
+                i += 1
+        if delay is None:
+            delay = 0.05 if self.pending else None  # only stale entries or sends past the scan window
+        return delay
+
+    async def run(self):
+        self.running = True
+        try:
+            while True:
+                delay = self._release_one()
+                if delay == 0:
+                    continue
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.running = False
+            # Let whoever is still queued go through unpaced rather than hang
+            for q in self.queues:
+                while q:
+                    chat_id, future, queued_at = q.popleft()
+                    if not future.done():
+                        future.set_result(None)
+            self.pending = 0
+            self.room.set()
+
+outbound = OutboundDispatcher(OUTBOUND_GLOBAL_RATE, OUTBOUND_MAX_PENDING)
+
+class OutboundMiddleware(BaseRequestMiddleware):
+    """Routes new messages through the outbound dispatcher"""
+
+    async def __call__(self, make_request, bot, method):
+        if type(method).__name__ not in OUTBOUND_METHODS:
+            return await make_request(bot, method)
+        chat_id = method.chat_id
+        await outbound.acquire(chat_id)
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            outbound.penalize(chat_id, e.retry_after)
+            raise
+
+bot.session.middleware(OutboundMiddleware())
+# Registered after the outbound gate, so API latency is network time rather than queueing
+bot.session.middleware(ApiMetricsMiddleware())
+
+START_BALANCE = 10000
+DAILY_BONUS_COOLDOWN = 24 * 3600
+
+class UserRecord:
+    """Everything kept per user; one instance per user in the users registry"""
+    __slots__ = ('balance', 'name', 'registered', 'banned', 'last_daily', 'blocked')
+
+    def __init__(self, balance=START_BALANCE, name='', registered=True, banned=False, last_daily=0, blocked=False):
+        self.balance = balance
+        self.name = name
+        self.registered = registered
+        self.banned = banned
+        self.last_daily = last_daily  # epoch seconds of the last daily bonus, 0 = never
+        self.blocked = blocked  # user blocked the bot; broadcasts skip them until they come back
+
+users = {}  # user_id -> UserRecord
+username_index = {}  # casefolded username -> {user_id: None} in claim order, latest claim last
+
+class Leaderboard:
+    """Users ranked by balance, kept sorted as balances change: top-K is O(K), a rank O(log n)"""
+
+    def __init__(self):
+        self.ranking = SortedList()  # (-balance, user_id): richest first, ties by ID
+
+    def __len__(self):
+        return len(self.ranking)
+
+    def rebuild(self, records):
+        self.ranking = SortedList((-rec.balance, uid) for uid, rec in records.items())
+
+    def add(self, user_id, balance):
+        self.ranking.add((-balance, user_id))
+
+    def update(self, user_id, old_balance, new_balance):
+        if old_balance != new_balance:
+            self.ranking.remove((-old_balance, user_id))
+            self.ranking.add((-new_balance, user_id))
+
+    def top(self, k, offset=0):
+        """[(user_id, balance)] for places offset+1 .. offset+k"""
+        return [(uid, -neg) for neg, uid in self.ranking.islice(offset, offset + k)]
+
+    def rank(self, user_id):
+        rec = users.get(user_id)
+        if rec is None:
+            return None
+        return self.ranking.index((-rec.balance, user_id)) + 1
+
+leaderboard = Leaderboard()
+
+class AggregateStats:
+    """Balance/duel aggregates updated on every change so admin_stats and the dashboard read them in O(1)"""
+    BUCKETS = (0, 1000, 5000, 10000, 20000, 50000, 100000, 1000000)  # histogram lower bounds
+
+    def __init__(self):
+        self.total = 0
+        self.above_start = 0
+        self.histogram = [0] * len(self.BUCKETS)
+        self.active_duels = set()
+
+    def _add(self, balance, sign):
+        self.total += sign * balance
+        self.above_start += sign * (balance > START_BALANCE)
+        self.histogram[bisect.bisect_right(self.BUCKETS, balance) - 1] += sign
+
+    def rebuild(self, records, duels):
+        self.total = 0
+        self.above_start = 0
+        self.histogram = [0] * len(self.BUCKETS)
+        for rec in records.values():
+            self._add(rec.balance, 1)
+        self.active_duels = {k for k, d in duels.items() if isinstance(d, dict) and 'scores' in d}
+
+    def add_balance(self, balance):
+        self._add(balance, 1)
+
+    def update_balance(self, old_balance, new_balance):
+        if old_balance != new_balance:
+            self._add(old_balance, -1)
+            self._add(new_balance, 1)
+
+    def duel_started(self, duel_id):
+        self.active_duels.add(duel_id)
+
+    def duel_finished(self, duel_id):
+        self.active_duels.discard(duel_id)
+
+    def snapshot(self):
+        top = leaderboard.top(1)
+        return {
+            'users': len(leaderboard),
+            'total': self.total,
+            'max': top[0][1] if top else 0,
+            'above_start': self.above_start,
+            'active_duels': len(self.active_duels),
+            'histogram': [(f'{low:,}+', n) for low, n in zip(self.BUCKETS, self.histogram)],
+        }
+
+aggregates = AggregateStats()
 pending_duels = {}
-random_queue = []
-last_daily = {}
+
+# Random duel queue: stakes are taken on join and refunded on leave or timeout
+RANDOM_DUEL_BET = 100
+MATCH_BET_TOLERANCE = int(os.getenv('MATCH_BET_TOLERANCE', '10'))  # max stake difference between opponents
+MATCH_TIMEOUT = float(os.getenv('MATCH_TIMEOUT', '600'))  # seconds in the queue before the stake is refunded
+MATCH_SWEEP_INTERVAL = 5  # seconds between timeout checks when nobody joins
+
+class QueueEntry:
+    __slots__ = ('user_id', 'bet', 'joined', 'chat_id', 'live')
+
+    def __init__(self, user_id, bet, joined, chat_id=None):
+        self.user_id = user_id
+        self.bet = bet
+        self.joined = joined  # epoch seconds, so timeouts survive restarts
+        self.chat_id = chat_id  # group the player joined from, None for private
+        self.live = True
+
+class Matchmaker:
+    """Waiting players in FIFO deques, one per bet bucket MATCH_BET_TOLERANCE + 1 wide.
+
+    Anyone in the same bucket is an acceptable opponent, and a neighbouring bucket only
+    needs its head checked, so each arrival is matched in O(1). members maps user id to
+    the live entry; leaving just marks the entry dead and the deques skip it at the head.
+    """
+
+    def __init__(self, tolerance, timeout):
+        self.tolerance = tolerance
+        self.timeout = timeout
+        self.width = tolerance + 1
+        self.buckets = {}  # bet // width -> deque of entries
+        self.members = {}  # user id -> live entry
+        self.arrivals = deque()  # joined but not yet looked at by the matcher
+        self.by_age = deque()  # entries in join order, for timeouts
+        self.wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, user_id):
+        return user_id in self.members
+
+    def _add(self, entry):
+        self.members[entry.user_id] = entry
+        self.buckets.setdefault(entry.bet // self.width, deque()).append(entry)
+        self.arrivals.append(entry)
+        self.by_age.append(entry)
+        self.wakeup.set()
+
+    def _drop(self, entry):
+        entry.live = False
+        self.members.pop(entry.user_id, None)
+
+    def join(self, user_id, bet, chat_id=None):
+        """Queue user_id with the stake debited; False if already queued or short of money"""
+        rec = get_user(user_id)
+        if user_id in self.members or rec.banned or rec.balance < bet:
+            return False
+        entry = QueueEntry(user_id, bet, time.time(), chat_id)
+        self._add(entry)
+        # The debit and the queue entry are persisted as one record
+        update_balance(user_id, -bet, game='duel', queue_op=('join', self._row(entry)))
+        persistence.mark_dirty('random_queue')
+        return True
+
+    def leave(self, user_id):
+        """Remove user_id from the queue and refund the stake"""
+        entry = self.members.get(user_id)
+        if entry is None:
+            return False
+        self._drop(entry)
+        self.refund(entry)
+        return True
+
+    def refund(self, entry):
+        """Give a dropped entry its stake back, durably removing it from the stored queue"""
+        user_id = entry.user_id
+        if get_user(user_id).banned:
+            balance_log.warning(f'Refunding queued stake {entry.bet} to banned user {user_id}',
+                                extra={'event': 'queue_refund_banned', 'user_id': user_id, 'game': 'duel', 'amount': entry.bet})
+        update_balance(user_id, entry.bet, game='duel', queue_op=('leave', user_id), even_banned=True)
+        persistence.mark_dirty('random_queue')
+
+    def clear(self):
+        """Refund everyone; returns how many players were waiting"""
+        count = len(self.members)
+        for user_id in list(self.members):
+            self.leave(user_id)
+        self.buckets.clear()
+        self.arrivals.clear()
+        self.by_age.clear()
+        return count
+
+    def _head(self, key):
+        q = self.buckets.get(key)
+        if q is None:
+            return None
+        while q and not q[0].live:
+            q.popleft()
+        if not q:
+            del self.buckets[key]
+            return None
+        return q[0]
+
+    def _find_opponent(self, entry):
+        key = entry.bet // self.width
+        head = self._head(key)
+        if head is not None and head is not entry:
+            return head
+        # entry heads its bucket: everyone queued before it in there is gone. Any two
+        # entries of one bucket match, so a processed bucket holds at most one live entry
+        # and walking a neighbour stays cheap; it only passes unprocessed arrivals.
+        for neighbour in (key - 1, key + 1):
+            if self._head(neighbour) is None:
+                continue
+            for other in self.buckets[neighbour]:
+                if other.live and abs(other.bet - entry.bet) <= self.tolerance:
+                    return other
+        return None
+
+    def requeue_heads(self):
+        """Offer every bucket head to the matcher again (sweep safety net)"""
+        for key in list(self.buckets):
+            head = self._head(key)
+            if head is not None:
+                self.arrivals.append(head)
+
+    def match_arrivals(self):
+        """Pair up new arrivals; returns [(earlier entry, later entry)]"""
+        pairs = []
+        while self.arrivals:
+            entry = self.arrivals.popleft()
+            if not entry.live:
+                continue
+            opponent = self._find_opponent(entry)
+            if opponent is not None:
+                self._drop(opponent)
+                self._drop(entry)
+                pairs.append((opponent, entry))
+        if pairs:
+            persistence.mark_dirty('random_queue')
+        return pairs
+
+    def expire(self, now=None):
+        """Refund and drop entries older than timeout; returns them"""
+        now = now or time.time()
+        expired = []
+        while self.by_age and (not self.by_age[0].live or now - self.by_age[0].joined >= self.timeout):
+            entry = self.by_age.popleft()
+            if entry.live:
+                self.leave(entry.user_id)
+                expired.append(entry)
+        return expired
+
+    @staticmethod
+    def _row(entry):
+        return [entry.user_id, entry.bet, entry.joined, entry.chat_id]
+
+    def snapshot(self):
+        return [self._row(e) for e in self.by_age if e.live]
+
+    def restore(self, rows):
+        self.buckets.clear()
+        self.members.clear()
+        self.arrivals.clear()
+        self.by_age.clear()
+        legacy = 0
+        for row in rows:
+            if len(row) < 3:
+                legacy += 1  # old [user, bet] rows: the stake was never taken, nothing to refund
+                continue
+            self._add(QueueEntry(*row))
+        if legacy:
+            logging.info(f'Dropped {legacy} random duel queue entries from the old format')
+
+    async def run(self, on_match, on_timeout):
+        """Background matcher: pairs arrivals as they come and sweeps timeouts"""
+        swept = None
+        while True:
+            for first, second in self.match_arrivals():
+                try:
+                    on_match(first, second)
+                except Exception as e:
+                    logging.error(f'Error starting random duel {first.user_id} vs {second.user_id}: {e}')
+                    self.refund(first)
+                    self.refund(second)
+            if swept is None or time.monotonic() - swept >= MATCH_SWEEP_INTERVAL:
+                swept = time.monotonic()
+                self.requeue_heads()
+                if self.arrivals:
+                    continue
+            for entry in self.expire():
+                try:
+                    on_timeout(entry)
+                except Exception as e:
+                    logging.error(f'Error handling random duel timeout for {entry.user_id}: {e}')
+            self.wakeup.clear()
+            if self.arrivals:
+                continue
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), MATCH_SWEEP_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+matchmaker = Matchmaker(MATCH_BET_TOLERANCE, MATCH_TIMEOUT)
 stats = {'total_bets': 0, 'total_wins': 0}
 feedbacks = []
 paused = False
 
-def load_data():
-    global balances, user_info, banned_users, pending_duels, random_queue, last_daily, stats
-    backup_created = False
+# Balance ledger: one compact record per balance change, data.json is only a periodic snapshot
+LEDGER_FILE = 'balances.ledger'
+LEDGER_COMMIT_INTERVAL = float(os.getenv('LEDGER_COMMIT_INTERVAL', '0.05'))  # max seconds a record waits for fsync
+LEDGER_COMMIT_BATCH = int(os.getenv('LEDGER_COMMIT_BATCH', '500'))  # max records per group commit
+
+class BalanceLedger:
+    """Append-only write-ahead log of balance deltas with group commit in a background thread"""
+
+    def __init__(self, path, commit_interval=0.05, commit_batch=500):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self.seq = 0  # last sequence number handed out
+        self.committed_seq = 0  # last sequence number fsync'd to disk
+        self.commits = 0
+        self._queue = queue.Queue()
+        self._file = None
+        self._thread = None
+
+    def replay(self, after_seq=0):
+        """Yield records newer than the snapshot; a torn last line from a crash is skipped"""
+        self.seq = max(self.seq, after_seq)
+        try:
+            f = open(self.path, 'r')
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    logging.warning(f'Skipping broken ledger line: {line[:100]!r}')
+                    continue
+                self.seq = max(self.seq, rec['s'])
+                if rec['s'] > after_seq:
+                    yield rec
+        self.committed_seq = self.seq
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._file = open(self.path, 'a')
+        self._thread = threading.Thread(target=self._writer, name='ledger-writer', daemon=True)
+        self._thread.start()
+
+    def append(self, user_id, delta, balance, queue_op=None):
+        self.seq += 1
+        self._queue.put(('rec', self.seq, user_id, delta, balance, int(time.time()), queue_op))
+        return self.seq
+
+    def compact(self, snapshot_seq):
+        """Drop records already covered by a snapshot; queued so it runs after every earlier append"""
+        self._queue.put(('compact', snapshot_seq))
+
+    def backlog(self):
+        """Records queued but not yet handed to the writer thread"""
+        return self._queue.qsize()
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+        self._thread = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _writer(self):
+        while True:
+            item = self._queue.get()
+            batch = []
+            stop = False
+            deadline = time.monotonic() + self.commit_interval
+            while item is not None:
+                if item[0] == 'compact':
+                    self._commit(batch)
+                    batch = []
+                    self._compact(item[1])
+                else:
+                    batch.append(item)
+                if len(batch) >= self.commit_batch:
+                    break
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            else:
+                stop = True
+            self._commit(batch)
+            if stop:
+                return
+
+    def _commit(self, batch):
+        if not batch:
+            return
+        try:
+            self._file.write(''.join(
+                json.dumps({'s': seq, 'u': uid, 'd': delta, 'b': bal, 't': ts, **({'q': op} if op else {})},
+                           separators=(',', ':')) + '\n'
+                for _, seq, uid, delta, bal, ts, op in batch
+            ))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.committed_seq = batch[-1][1]
+            self.commits += 1
+        except Exception as e:
+            logging.error(f'Ledger commit failed ({len(batch)} records): {e}')
+
+    def _compact(self, snapshot_seq):
+        # The snapshot is written off the event loop, so records newer than it may already be on disk: keep those
+        try:
+            self._file.close()
+            tail = []
+            if self.committed_seq > snapshot_seq:
+                with open(self.path, 'r') as f:
+                    for line in f:
+                        try:
+                            if json.loads(line)['s'] > snapshot_seq:
+                                tail.append(line)
+                        except ValueError:
+                            pass
+            tmp = f'{self.path}.tmp'
+            with open(tmp, 'w') as f:
+                f.writelines(tail)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            logging.info(f'Ledger compacted into snapshot at seq {snapshot_seq}, kept {len(tail)} newer records')
+        except Exception as e:
+            logging.error(f'Ledger compaction failed: {e}')
+        finally:
+            self._file = open(self.path, 'a')
+
+# Snapshot encoding: pretty json (default), compact orjson, or gzip-compressed compact json
+SNAPSHOT_FORMAT = os.getenv('SNAPSHOT_FORMAT', 'json').lower()
+
+def encode_snapshot(data, fmt=SNAPSHOT_FORMAT):
+    if fmt == 'json':
+        return json.dumps(data, indent=2).encode()  # Pretty print for readability
+    if orjson is not None:
+        payload = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    else:
+        payload = json.dumps(data, separators=(',', ':')).encode()
+    if fmt == 'gzip':
+        return gzip.compress(payload, compresslevel=6, mtime=0)
+    return payload
+
+def decode_snapshot(raw):
+    """Load a snapshot in any format encode_snapshot can produce"""
+    if raw[:2] == b'\x1f\x8b':  # gzip magic
+        raw = gzip.decompress(raw)
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def atomic_write(path, payload):
+    """temp file + fsync + rename, so a crash never leaves a half-written file behind"""
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
     try:
-        with open('data.json', 'r') as f:
-            raw_data = f.read()
-        data = json.loads(raw_data)
-        # Clean and merge balances: take max for duplicates
-        temp_bal = data.get('balances', {})
-        balances = {}
-        for k, v in temp_bal.items():
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass  # Not supported on every platform
+
+# Storage backends: JSON snapshot + ledger (default) or SQLite, selected by STORAGE_BACKEND
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json').lower()
+DATA_FILE = 'data.json'
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'depbot.db')
+
+def upgrade_snapshot(data):
+    """Convert the old balances/user_info/banned_users/last_daily layout (or build_snapshot's
+    (user_id, fields) rows) into users"""
+    if isinstance(data.get('users'), list):
+        data['users'] = {uid: dict(zip(UserRecord.__slots__, row)) for uid, row in data['users']}
+    if 'users' in data:
+        return data
+    users_raw = {}
+    for k, info in data.get('user_info', {}).items():
+        users_raw[str(k)] = {'name': info.get('name', ''), 'registered': info.get('registered', True),
+                             'balance': info.get('balance', START_BALANCE)}
+    for k, bal in data.get('balances', {}).items():
+        users_raw.setdefault(str(k), {})['balance'] = bal
+    for k in data.get('banned_users', []):
+        users_raw.setdefault(str(k), {})['banned'] = True
+    for k, v in data.get('last_daily', {}).items():
+        try:
+            users_raw.setdefault(str(k), {})['last_daily'] = int(datetime.fromisoformat(str(v).replace('Z', '+00:00')).timestamp())
+        except ValueError:
+            pass
+    data['users'] = users_raw
+    return data
+
+def apply_queue_op(rows, op):
+    """Replay a durable random duel queue join/leave onto snapshot rows"""
+    kind, arg = op
+    user_id = arg[0] if kind == 'join' else arg
+    rows = [row for row in rows if row[0] != user_id]
+    if kind == 'join':
+        rows.append(list(arg))
+    return rows
+
+class Storage(ABC):
+    """Persistence interface behind load_data/save_data/update_balance.
+
+    load() returns state in the data.json layout, save() persists a snapshot built by
+    build_snapshot() (a partial one if partial_writes is set) and may run in a worker
+    thread, record_balance() persists a single balance change as cheaply as the backend allows.
+    A queue_op (('join', [user, bet, joined, chat]) or ('leave', user)) passed along with a
+    balance change is persisted atomically with it, so a queued stake is never lost or doubled.
+    """
+    partial_writes = False
+
+    @abstractmethod
+    def load(self):
+        ...
+
+    @abstractmethod
+    def save(self, data):
+        ...
+
+    def checkpoint(self):
+        """Marker taken on the event loop together with the snapshot copy"""
+        return 0
+
+    def submit(self, data):
+        """Called on the event loop right after the snapshot is built. A backend with its own
+        writer queues the save here, in order with record_balance, and returns a Future;
+        None means save() will be called from the worker thread instead."""
+        return None
+
+    @abstractmethod
+    def record_balance(self, user_id, delta, balance, queue_op=None):
+        ...
+
+    def start(self):
+        pass
+
+    def backlog(self):
+        """Writes queued for a background writer"""
+        return 0
+
+    def close(self):
+        pass
+
+class JsonStorage(Storage):
+    """data.json snapshot plus balances.ledger tail"""
+
+    def __init__(self, path=DATA_FILE):
+        self.path = path
+        self.ledger = BalanceLedger(LEDGER_FILE, LEDGER_COMMIT_INTERVAL, LEDGER_COMMIT_BATCH)
+
+    def load(self):
+        raw_data = None
+        try:
+            with open(self.path, 'rb') as f:
+                raw_data = f.read()
+            data = decode_snapshot(raw_data)
+        except FileNotFoundError:
+            logging.info(f'No {self.path} snapshot yet, rebuilding from ledger')
+            data = {}
+        except (ValueError, EOFError, gzip.BadGzipFile) as e:
+            logging.error(f'Snapshot decode error: {e}. Raw data preview: {raw_data[:200]}')
+            # Backup corrupt file
             try:
-                uid = int(k)
-                val = int(v) if isinstance(v, (int, float)) else 10000
-                balances[uid] = max(balances.get(uid, 0), val)
+                with open('data_corrupt_backup.json', 'wb') as f:
+                    f.write(raw_data)
             except:
                 pass
-        # Load and clean user_info safely
-        user_info_raw = data.get('user_info', {})
-        user_info = {}
-        for uid_str, info in user_info_raw.items():
+            logging.warning('Reset to defaults due to corrupt JSON. Backup created if possible.')
+            data = {}
+        snapshot_seq = data.get('ledger_seq', 0)
+        users_raw = upgrade_snapshot(data)['users']
+        replayed = 0
+        for rec in self.ledger.replay(snapshot_seq):
+            # Snapshot keys are strings, so overwrite by str(uid) instead of adding a duplicate int key
+            users_raw.setdefault(str(rec['u']), {})['balance'] = rec['b']
+            if 'q' in rec:
+                data['random_queue'] = apply_queue_op(data.get('random_queue', []), rec['q'])
+            replayed += 1
+        if replayed:
+            logging.info(f'Replayed {replayed} ledger records after snapshot seq {snapshot_seq}')
+        return data
+
+    def save(self, data):
+        atomic_write(self.path, encode_snapshot(upgrade_snapshot(data)))
+        self.ledger.compact(data['ledger_seq'])
+
+    def checkpoint(self):
+        return self.ledger.seq  # the snapshot copy contains every record up to this seq
+
+    def record_balance(self, user_id, delta, balance, queue_op=None):
+        self.ledger.append(user_id, delta, balance, queue_op)
+
+    def start(self):
+        self.ledger.start()
+
+    def backlog(self):
+        return self.ledger.backlog()
+
+    def close(self):
+        self.ledger.close()
+
+class SqliteStorage(Storage):
+    """SQLite in WAL mode; balance changes are single-row UPSERTs.
+
+    Once started, every write (balance UPSERTs and snapshots) goes through one writer
+    thread in submission order, so the event loop never waits on the database lock.
+    Snapshots are queued by submit() on the event loop as soon as they are built, so a
+    balance changed after the copy is always written after the snapshot, never before it.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            balance INTEGER NOT NULL DEFAULT 10000,
+            name TEXT NOT NULL DEFAULT '',
+            registered INTEGER NOT NULL DEFAULT 1,
+            banned INTEGER NOT NULL DEFAULT 0,
+            last_daily INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_name ON users(name COLLATE NOCASE);
+        CREATE INDEX IF NOT EXISTS idx_users_balance ON users(balance);
+        CREATE TABLE IF NOT EXISTS duels (duel_key TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS feedbacks (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            username TEXT NOT NULL DEFAULT '',
+            message TEXT NOT NULL DEFAULT '',
+            timestamp TEXT NOT NULL DEFAULT '',
+            replied INTEGER NOT NULL DEFAULT 0,
+            reply TEXT NOT NULL DEFAULT ''
+        );
+        CREATE INDEX IF NOT EXISTS idx_feedbacks_user ON feedbacks(user_id, replied);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS random_queue (
+            user_id INTEGER PRIMARY KEY,
+            bet INTEGER NOT NULL,
+            joined REAL NOT NULL,
+            chat_id INTEGER
+        );
+    """
+    # Constant SQL strings so sqlite3's statement cache keeps them prepared
+    UPSERT_BALANCE = 'INSERT INTO users (user_id, balance) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET balance = excluded.balance'
+    UPSERT_USER = ('INSERT INTO users (user_id, balance, name, registered, banned, last_daily, blocked) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                   'ON CONFLICT(user_id) DO UPDATE SET balance = excluded.balance, name = excluded.name, '
+                   'registered = excluded.registered, banned = excluded.banned, last_daily = excluded.last_daily, '
+                   'blocked = excluded.blocked')
+    UPSERT_META = 'INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value'
+    UPSERT_QUEUE = 'INSERT OR REPLACE INTO random_queue (user_id, bet, joined, chat_id) VALUES (?, ?, ?, ?)'
+    INSERT_FEEDBACK = 'INSERT INTO feedbacks (id, user_id, username, message, timestamp, replied, reply) VALUES (?, ?, ?, ?, ?, ?, ?)'
+
+    partial_writes = True
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        is_new = not os.path.exists(path)
+        # One connection per thread: loads on the event loop, writes in the writer thread
+        self._local = threading.local()
+        self._conns = []
+        self._queue = queue.Queue()
+        self._thread = None
+        self._conn().executescript(self.SCHEMA)
+        if is_new and os.path.exists(DATA_FILE):
+            # One-time migration from the JSON snapshot + ledger
+            try:
+                self.save(JsonStorage().load())
+                logging.info(f'Migrated {DATA_FILE} into {path}')
+            except Exception as e:
+                logging.error(f'Migration of {DATA_FILE} into {path} failed, starting with an empty store: {e}')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, cached_statements=64, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=5000')
+            self._local.conn = conn
+            self._conns.append(conn)
+        return conn
+
+    def load(self):
+        c = self._conn()
+        meta = {k: json.loads(v) for k, v in c.execute('SELECT key, value FROM meta')}
+        return {
+            'users': {
+                uid: {'balance': bal, 'name': name, 'registered': bool(registered), 'banned': bool(banned),
+                      'last_daily': last, 'blocked': bool(blocked)}
+                for uid, bal, name, registered, banned, last, blocked in c.execute(
+                    'SELECT user_id, balance, name, registered, banned, last_daily, blocked FROM users')
+            },
+            'pending_duels': {k: json.loads(v) for k, v in c.execute('SELECT duel_key, data FROM duels')},
+            'random_queue': [list(row) for row in c.execute(
+                'SELECT user_id, bet, joined, chat_id FROM random_queue ORDER BY joined')],
+            'stats': meta.get('stats', {'total_bets': 0, 'total_wins': 0}),
+            'feedbacks': [
+                {'user_id': uid, 'username': username, 'message': msg, 'timestamp': ts, 'replied': bool(replied), 'reply': reply}
+                for uid, username, msg, ts, replied, reply in c.execute(
+                    'SELECT user_id, username, message, timestamp, replied, reply FROM feedbacks ORDER BY id')
+            ],
+            'paused': meta.get('paused', False),
+        }
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._writer, name='sqlite-writer', daemon=True)
+        self._thread.start()
+
+    def backlog(self):
+        return self._queue.qsize()
+
+    def save(self, data):
+        """Blocks the calling thread until the writer has committed the snapshot"""
+        if self._thread is None:
+            return self._save(data)
+        return self.submit(data).result()
+
+    def submit(self, data):
+        if self._thread is None:
+            return None
+        done = concurrent.futures.Future()
+        self._queue.put(('save', data, done))
+        return done
+
+    def record_balance(self, user_id, delta, balance, queue_op=None):
+        if self._thread is None:
+            self._write_balances([(user_id, balance, queue_op)])
+        else:
+            self._queue.put(('balance', user_id, balance, queue_op))
+
+    def _writer(self):
+        item = None
+        while True:
+            if item is None:
+                item = self._queue.get()
+            if item is None or item[0] == 'stop':
+                return
+            if item[0] == 'save':
+                _, data, done = item
+                item = None
+                try:
+                    self._save(data)
+                    done.set_result(None)
+                except Exception as e:
+                    done.set_exception(e)
+                continue
+            # Group consecutive balance changes into one transaction
+            batch = [item[1:]]
+            item = None
+            while len(batch) < LEDGER_COMMIT_BATCH:
+                try:
+                    nxt = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt[0] != 'balance':
+                    item = nxt
+                    break
+                batch.append(nxt[1:])
             try:
-                uid = int(uid_str)
-                if uid in user_info:
-                    # Merge duplicates
-                    user_info[uid]['name'] = info.get('name', user_info[uid].get('name', ''))
-                    user_info[uid]['balance'] = info.get('balance', user_info[uid].get('balance', 10000))
-                    user_info[uid]['registered'] = info.get('registered', True)
+                self._write_balances(batch)
+            except Exception as e:
+                logging.error(f'SQLite balance write failed ({len(batch)} changes): {e}')
+
+    def _write_balances(self, batch):
+        c = self._conn()
+        c.execute('BEGIN')
+        try:
+            for user_id, balance, queue_op in batch:
+                c.execute(self.UPSERT_BALANCE, (user_id, balance))
+                if queue_op is None:
+                    continue
+                kind, arg = queue_op
+                if kind == 'join':
+                    c.execute(self.UPSERT_QUEUE, tuple(arg))
                 else:
-                    info_copy = info.copy()
-                    info_copy['registered'] = info_copy.get('registered', True)
-                    info_copy['balance'] = info_copy.get('balance', 10000)
-                    user_info[uid] = info_copy
-            except ValueError:
-                pass
-        # Sync balances from user_info if missing
-        for uid, info in user_info.items():
-            if uid not in balances:
-                balances[uid] = info.get('balance', 10000)
-                logging.info(f'Synced balance {balances[uid]} from user_info for {uid}')
-        banned_users = set()
-        for u_str in data.get('banned_users', []):
+                    c.execute('DELETE FROM random_queue WHERE user_id = ?', (arg,))
+            c.execute('COMMIT')
+        except Exception:
+            c.execute('ROLLBACK')
+            raise
+
+    def _save(self, data):
+        # data holds only the dirty collections (see build_snapshot): balances are already persisted
+        # row by row in record_balance, so only the users whose other fields changed are rewritten
+        data = upgrade_snapshot(data)
+        c = self._conn()
+        c.execute('BEGIN')
+        try:
+            c.executemany(self.UPSERT_USER, (
+                (int(uid), int(u.get('balance', START_BALANCE)), u.get('name', ''), int(u.get('registered', True)),
+                 int(u.get('banned', False)), int(u.get('last_daily', 0)), int(u.get('blocked', False)))
+                for uid, u in data['users'].items()
+            ))
+            if 'pending_duels' in data:
+                c.execute('DELETE FROM duels')
+                c.executemany('INSERT INTO duels (duel_key, data) VALUES (?, ?)',
+                              ((str(k), json.dumps(v)) for k, v in data['pending_duels'].items()))
+            if 'feedbacks' in data:
+                c.execute('DELETE FROM feedbacks')
+                c.executemany(self.INSERT_FEEDBACK, (
+                    (i, fb['user_id'], fb.get('username', ''), fb.get('message', ''), fb.get('timestamp', ''), int(fb.get('replied', False)), fb.get('reply', ''))
+                    for i, fb in enumerate(data['feedbacks'], 1)
+                ))
+            # Matches leave the queue here, in the same transaction as the duels they start
+            c.execute('DELETE FROM random_queue')
+            c.executemany(self.UPSERT_QUEUE, (tuple(row) for row in data['random_queue'] if len(row) >= 3))
+            # stats change alongside every bet and are tiny, so meta is written on every flush
+            c.executemany(self.UPSERT_META, (
+                (key, json.dumps(data[key])) for key in ('stats', 'paused')
+            ))
+            c.execute('COMMIT')
+        except Exception:
+            c.execute('ROLLBACK')
+            raise
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(('stop',))
+            self._thread.join(timeout=10)
+            self._thread = None
+        for conn in self._conns:
             try:
-                banned_users.add(int(u_str))
-            except ValueError:
+                conn.close()
+            except Exception as e:
+                logging.error(f'Error closing {self.path}: {e}')
+        self._conns = []
+        self._local = threading.local()
+
+def create_storage(backend):
+    if backend == 'sqlite':
+        return SqliteStorage()
+    if backend != 'json':
+        logging.warning(f'Unknown STORAGE_BACKEND {backend!r}, falling back to json')
+    return JsonStorage()
+
+storage_backend = create_storage(STORAGE_BACKEND)
+
+def rebuild_username_index():
+    username_index.clear()
+    for uid, rec in users.items():
+        if rec.name:
+            username_index.setdefault(rec.name.casefold(), {})[uid] = None
+
+def load_data():
+    global users, pending_duels, stats, feedbacks, paused
+    try:
+        data = upgrade_snapshot(storage_backend.load())
+        users = {}
+        for uid_str, raw in data['users'].items():
+            try:
+                bal = raw.get('balance', START_BALANCE)
+                users[int(uid_str)] = UserRecord(
+                    int(bal) if isinstance(bal, (int, float)) else START_BALANCE,
+                    raw.get('name') or '',
+                    bool(raw.get('registered', True)),
+                    bool(raw.get('banned', False)),
+                    int(raw.get('last_daily', 0)),
+                    bool(raw.get('blocked', False)),
+                )
+            except (ValueError, TypeError, AttributeError):
                 pass
         pending_duels_raw = data.get('pending_duels', {})
         pending_duels = {}
@@ -139,110 +2108,515 @@ def load_data():
                 pending_duels[k] = v
             except ValueError:
                 pass
-        random_queue = data.get('random_queue', [])
+        matchmaker.restore(data.get('random_queue', []))
         stats = data.get('stats', {'total_bets': 0, 'total_wins': 0})
         feedbacks = data.get('feedbacks', [])
-        last_daily_dict = data.get('last_daily', {})
-        last_daily = {}
-        for k_str, v in last_daily_dict.items():
-            try:
-                k = int(k_str)
-                last_daily[k] = datetime.fromisoformat(str(v).replace('Z', '+00:00'))  # Handle timezone
-            except:
-                pass
         paused = data.get('paused', False)
-        logging.info(f'Data loaded successfully: {len(balances)} users, total balance {sum(balances.values())}')
-        logging.info(f'Loaded balances sample: {dict(list(balances.items())[:3])}')
-        logging.info(f'Loaded user_info: {len(user_info)} users')
+        rebuild_username_index()
+        leaderboard.rebuild(users)
+        aggregates.rebuild(users, pending_duels)
+        logging.info(f'Data loaded successfully ({STORAGE_BACKEND}): {len(users)} users, total balance {sum(u.balance for u in users.values())}')
+        logging.info(f'Loaded users sample: {[(uid, u.balance) for uid, u in list(users.items())[:3]]}')
         logging.info(f'Loaded feedbacks: {len(feedbacks)}')
-    except json.JSONDecodeError as e:
-        logging.error(f'JSON decode error: {e}. Raw data preview: {raw_data[:200] if "raw_data" in locals() else "N/A"}')
-        # Backup corrupt file
-        try:
-            with open('data_corrupt_backup.json', 'w') as f:
-                f.write(raw_data)
-            backup_created = True
-        except:
-            pass
-        # Reset to defaults
-        balances = {}
-        user_info = {}
-        banned_users = set()
-        pending_duels = {}
-        random_queue = []
-        stats = {'total_bets': 0, 'total_wins': 0}
-        last_daily = {}
-        logging.warning('Reset to defaults due to corrupt JSON. Backup created if possible.')
     except Exception as e:
         logging.error(f'Unexpected load error: {e}')
-        balances = {}
-        user_info = {}
-        banned_users = set()
+        users = {}
         pending_duels = {}
-        random_queue = []
+        matchmaker.restore([])
         stats = {'total_bets': 0, 'total_wins': 0}
-        last_daily = {}
 
-def save_data():
-    last_daily_dict = {str(k): v.isoformat() for k, v in last_daily.items()}
+SNAPSHOT_KEYS = ('users', 'pending_duels', 'random_queue', 'stats', 'feedbacks', 'paused', 'ledger_seq')
+
+# A snapshot carries users as (user_id, fields tuple) rows: cheap to take on the loop,
+# turned into dicts by write_snapshot in the worker thread
+user_row = operator.attrgetter(*UserRecord.__slots__)
+duels_copy = None  # pending_duels as of the last snapshot, re-copied only when marked dirty
+
+def build_snapshot(dirty=None):
+    """Copy state on the event loop so encoding and disk I/O can run in a worker thread.
+
+    Backends without partial writes always get everything; otherwise only the dirty
+    collections (and only the dirty user records) are copied.
+    """
+    global duels_copy
+    if dirty is None or 'pending_duels' in dirty or duels_copy is None:
+        # Duels are flat apart from the scores dict, so a two-level copy is enough
+        duels_copy = {k: {**d, 'scores': dict(d['scores'])} if 'scores' in d else dict(d)
+                      for k, d in pending_duels.items()}
+    if not storage_backend.partial_writes:
+        dirty = None
+    def wants(name):
+        return dirty is None or name in dirty
     data = {
-        'balances': balances,
-        'user_info': user_info,
-        'banned_users': list(banned_users),
-        'pending_duels': pending_duels,
-        'random_queue': random_queue,
-        'last_daily': last_daily_dict,
-        'stats': stats,
-        'feedbacks': feedbacks,
-        'paused': paused
+        'random_queue': matchmaker.snapshot(),
+        'stats': dict(stats),
+        'paused': paused,
+        'ledger_seq': storage_backend.checkpoint(),
     }
+    if wants('users'):
+        keys = dirty['users'] if dirty is not None else None
+        if keys is None:
+            data['users'] = [(uid, user_row(rec)) for uid, rec in users.items()]
+        else:
+            data['users'] = [(uid, user_row(users[uid])) for uid in keys if uid in users]
+    if wants('pending_duels'):
+        data['pending_duels'] = duels_copy
+    if wants('feedbacks'):
+        data['feedbacks'] = [dict(fb) for fb in feedbacks]
+    return {key: data[key] for key in SNAPSHOT_KEYS if key in data}
+
+# Snapshots are numbered on the loop; writes are serialized and a snapshot older than the
+# one already on disk is dropped, so the shutdown save can't race an in-flight background write
+snapshot_lock = threading.Lock()
+snapshot_seq = 0
+written_seq = 0
+
+def write_snapshot(data, seq=None, queued=None):
+    """queued is the Future of a save the backend already ordered itself (see Storage.submit)"""
+    global written_seq
+    with snapshot_lock:
+        if queued is None and seq is not None and seq <= written_seq:
+            logging.info(f'Skipping snapshot {seq}: snapshot {written_seq} is already on disk')
+            return True
+        ok = _write_snapshot(data, queued)
+        if ok and seq is not None:
+            written_seq = max(written_seq, seq)
+        return ok
+
+def _write_snapshot(data, queued=None):
     try:
-        with open('data.json', 'w') as f:
-            json.dump(data, f, indent=2)  # Pretty print for readability
-        logging.info(f'Data saved: {len(balances)} users, balances total {sum(balances.values())}')
+        started = time.perf_counter()
+        if queued is None:
+            storage_backend.save(data)
+        else:
+            queued.result()
+        elapsed = time.perf_counter() - started
+        save_latency.observe(elapsed)
+        duration = round(elapsed * 1000, 2)
+        if 'users' in data:
+            logging.info(f'Data saved: {len(data["users"])} users, balances total {sum(u["balance"] for u in data["users"].values())}',
+                         extra={'event': 'save', 'duration': duration})
+        else:
+            logging.info(f'Data saved: {", ".join(k for k in data if k != "ledger_seq")}',
+                         extra={'event': 'save', 'duration': duration})
+        return True
     except Exception as e:
         logging.error(f'Failed to save data: {e}')
+        return False
+
+def next_snapshot_seq():
+    global snapshot_seq
+    snapshot_seq += 1
+    return snapshot_seq
+
+def save_data(dirty=None):
+    """Blocking save, used at startup/shutdown; waits for any background write still in flight"""
+    snapshot = build_snapshot(dirty)
+    return write_snapshot(snapshot, next_snapshot_seq(), storage_backend.submit(snapshot))
+
+async def save_data_async(dirty=None):
+    snapshot = build_snapshot(dirty)
+    return await asyncio.to_thread(write_snapshot, snapshot, next_snapshot_seq(), storage_backend.submit(snapshot))
+
+# Debounced persistence: handlers mark collections dirty, the scheduler coalesces them into one flush
+PERSIST_MAX_LATENCY = float(os.getenv('PERSIST_MAX_LATENCY', '2'))  # seconds a dirty collection may wait
+PERSIST_MAX_PENDING = int(os.getenv('PERSIST_MAX_PENDING', '100'))  # flush early after this many mutations
+SNAPSHOT_INTERVAL = float(os.getenv('SNAPSHOT_INTERVAL', '30'))  # snapshot period for changes already in the ledger
 
-atexit.register(save_data)
+class PersistenceScheduler:
+    """Tracks dirty collections and flushes them in batches.
+
+    Durable marks (balances, already written to the ledger/DB per change) only need a
+    periodic snapshot; everything else is flushed at most max_latency after the first
+    mark or as soon as max_pending mutations pile up.
+    """
+
+    def __init__(self, flush, max_latency=2.0, max_pending=100, snapshot_interval=30.0):
+        self.flush_fn = flush
+        self.max_latency = max_latency
+        self.max_pending = max_pending
+        self.snapshot_interval = snapshot_interval
+        self.dirty = {}  # collection -> set of keys, or None for the whole collection
+        self.pending_ops = 0
+        self.urgent_since = None
+        self.last_flush_at = time.monotonic()
+        self.flush_count = 0
+        self.failed_flushes = 0
+        self.skipped_idle = 0
+        self.coalesced_ops = 0
+        self.last_flush_duration = 0.0
+        self.total_flush_duration = 0.0
+        self.max_flush_duration = 0.0
+        self._wakeup = None
+
+    def mark_dirty(self, *collections, key=None, durable=False):
+        for name in collections:
+            if key is None:
+                self.dirty[name] = None
+            elif self.dirty.get(name, ()) is not None:
+                self.dirty.setdefault(name, set()).add(key)
+        if durable:
+            return
+        self.pending_ops += 1
+        if self.urgent_since is None:
+            self.urgent_since = time.monotonic()
+            self._wake()
+        elif self.pending_ops >= self.max_pending:
+            self._wake()
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def flush(self):
+        if not self.dirty:
+            self.skipped_idle += 1
+            return False
+        dirty, ops = self.dirty, self.pending_ops
+        self.dirty = {}
+        self.pending_ops = 0
+        self.urgent_since = None
+        started = time.perf_counter()
+        try:
+            ok = await self.flush_fn(dirty) is not False
+        except Exception as e:
+            logging.error(f'Persistence flush failed: {e}')
+            ok = False
+        if not ok:
+            # Keep the marks so the next flush retries them; a failure isn't counted as a flush
+            for name, keys in dirty.items():
+                if keys is None or self.dirty.get(name, ()) is None:
+                    self.dirty[name] = None
+                else:
+                    self.dirty.setdefault(name, set()).update(keys)
+            self.pending_ops += ops
+            self.urgent_since = self.urgent_since or time.monotonic()
+            self.failed_flushes += 1
+            flushes_total.inc('failed')
+            return True
+        duration = time.perf_counter() - started
+        flushes_total.inc('ok')
+        flush_latency.observe(duration)
+        self.last_flush_at = time.monotonic()
+        self.flush_count += 1
+        self.coalesced_ops += ops
+        self.last_flush_duration = duration
+        self.total_flush_duration += duration
+        self.max_flush_duration = max(self.max_flush_duration, duration)
+        return True
+
+    def _next_deadline(self):
+        if self.urgent_since is not None:
+            if self.pending_ops >= self.max_pending:
+                return 0
+            return self.urgent_since + self.max_latency
+        return self.last_flush_at + self.snapshot_interval
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        while True:
+            timeout = self._next_deadline() - time.monotonic()
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                if self._next_deadline() > time.monotonic():
+                    continue
+            try:
+                if not await self.flush():
+                    self.last_flush_at = time.monotonic()
+            except Exception as e:
+                logging.error(f'Persistence flush failed: {e}')
+
+    def summary(self):
+        avg = self.total_flush_duration / self.flush_count if self.flush_count else 0
+        return {
+            'flushes': self.flush_count,
+            'failed': self.failed_flushes,
+            'skipped_idle': self.skipped_idle,
+            'coalesced_ops': self.coalesced_ops,
+            'pending_ops': self.pending_ops,
+            'dirty': sorted(self.dirty),
+            'last_ms': self.last_flush_duration * 1000,
+            'avg_ms': avg * 1000,
+            'max_ms': self.max_flush_duration * 1000,
+        }
+
+persistence = PersistenceScheduler(save_data_async, PERSIST_MAX_LATENCY, PERSIST_MAX_PENDING, SNAPSHOT_INTERVAL)
+
+persistence_closed = False
+
+def shutdown_persistence():
+    """Final save and backend close: runs from main()'s finally, atexit only covers other exits"""
+    global persistence_closed
+    if persistence_closed:
+        return
+    persistence_closed = True
+    save_data()
+    storage_backend.close()
+
+atexit.register(shutdown_persistence)
 
 load_data()
+storage_backend.start()
+
+
+def record_balance(user_id, delta, balance, queue_op=None):
+    """Write a balance change through the storage backend, charging the time to the current update"""
+    started = time.perf_counter()
+    storage_backend.record_balance(user_id, delta, balance, queue_op)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.persist_time += time.perf_counter() - started
+
+def get_user(user_id):
+    """Registry lookup that registers unknown users with the start balance"""
+    rec = users.get(user_id)
+    if rec is None:
+        rec = users[user_id] = UserRecord()
+        leaderboard.add(user_id, rec.balance)
+        aggregates.add_balance(rec.balance)
+        balance_log.info(f'Registered user {user_id} with balance {rec.balance}',
+                         extra={'event': 'register', 'user_id': user_id, 'amount': rec.balance})
+        record_balance(user_id, 0, rec.balance)
+        persistence.mark_dirty('balances', durable=True)
+    return rec
+
+def find_user_by_name(username):
+    owners = username_index.get(username.casefold())
+    return next(reversed(owners)) if owners else None
+
+def user_name(user_id, default='User'):
+    rec = users.get(user_id)
+    return rec.name if rec is not None else default
+
+def is_banned(user_id):
+    rec = users.get(user_id)
+    return rec is not None and rec.banned
+
+def set_user_name(user_id, name):
+    rec = get_user(user_id)
+    if rec.name != name:
+        # Every claimant of a name stays indexed, so the earlier owner is findable again
+        # once the latest claimant renames; lookups return the latest claim
+        old_key = rec.name.casefold()
+        owners = username_index.get(old_key)
+        if owners is not None:
+            owners.pop(user_id, None)
+            if not owners:
+                del username_index[old_key]
+        if name:
+            owners = username_index.setdefault(name.casefold(), {})
+            owners.pop(user_id, None)
+            owners[user_id] = None
+        rec.name = name
+        persistence.mark_dirty('users', key=user_id)
+    return rec
+
+# bot.get_chat cache for @usernames not known locally: each lookup is a rate-limited API round trip
+CHAT_CACHE_TTL = float(os.getenv('CHAT_CACHE_TTL', '3600'))  # seconds a resolved username is kept
+CHAT_CACHE_NEGATIVE_TTL = float(os.getenv('CHAT_CACHE_NEGATIVE_TTL', '300'))  # seconds a "not found" is kept
+CHAT_CACHE_SIZE = int(os.getenv('CHAT_CACHE_SIZE', '1024'))
+
+class ChatLookupCache:
+    """TTL + LRU cache around bot.get_chat('@name') with negative entries and in-flight coalescing"""
+
+    def __init__(self, ttl, negative_ttl, max_size):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # casefolded username -> (expires_at, chat_id or None)
+        self.inflight = {}  # casefolded username -> task shared by concurrent lookups
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def resolve(self, username):
+        """Chat ID for @username; raises LookupError if Telegram doesn't know the name"""
+        key = username.casefold()
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            chat_id = entry[1]
+        else:
+            task = self.inflight.get(key)
+            if task is None:
+                self.misses += 1
+                task = self.inflight[key] = asyncio.create_task(self._fetch(key, username))
+                task.add_done_callback(lambda _: self.inflight.pop(key, None))
+            else:
+                self.coalesced += 1
+            chat_id = await asyncio.shield(task)
+        if chat_id is None:
+            raise LookupError(f'chat @{username} not found')
+        return chat_id
 
+    async def _fetch(self, key, username):
+        try:
+            chat = await bot.get_chat(f'@{username}')
+            chat_id, ttl = chat.id, self.ttl
+        except TelegramBadRequest:
+            # Unknown username: remember the miss; other errors (network, flood) are not cached
+            chat_id, ttl = None, self.negative_ttl
+        self.entries[key] = (time.monotonic() + ttl, chat_id)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return chat_id
+
+    def summary(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'size': len(self.entries),
+            'hit_rate': (self.hits + self.coalesced) / lookups * 100 if lookups else 0,
+        }
+
+chat_lookup = ChatLookupCache(CHAT_CACHE_TTL, CHAT_CACHE_NEGATIVE_TTL, CHAT_CACHE_SIZE)
+
+def mentioned_user_id(entity):
+    """Resolve a text_mention entity (users without @username) straight to an ID; nobody is registered here"""
+    if entity.type == 'text_mention' and entity.user is not None:
+        return entity.user.id
+    return None
 
 def get_balance(user_id):
-    if user_id in banned_users:
+    if is_banned(user_id):
         return 0
-    # Ensure user in balances and user_info
-    if user_id not in user_info:
-        user_info[user_id] = {'name': '', 'registered': True, 'balance': 10000}
-    if user_id not in balances:
-        balances[user_id] = user_info[user_id].get('balance', 10000)
-        logging.info(f'Restored balance {balances[user_id]} for existing user {user_id}')
-        save_data()
-    else:
-        # Sync balance to user_info if missing
-        if 'balance' not in user_info[user_id]:
-            user_info[user_id]['balance'] = balances[user_id]
-    return balances[user_id]
-
-def update_balance(user_id, amount):
-    if user_id not in banned_users:
-        balances[user_id] = max(0, balances[user_id] + amount)
-        if user_id not in user_info:
-            user_info[user_id] = {'name': '', 'registered': True}
-        user_info[user_id]['balance'] = balances[user_id]
-        logging.info(f'Balance update for {user_id}: +{amount}')
-        save_data()
+    return get_user(user_id).balance
+
+def update_balance(user_id, amount, game=None, queue_op=None, even_banned=False):
+    """Apply amount to a balance; banned users are frozen unless even_banned (refunds of held stakes)"""
+    rec = get_user(user_id)
+    if even_banned or not rec.banned:
+        old_balance = rec.balance
+        if rec.balance + amount < 0:
+            balance_log.warning(f'Overdraft for {user_id}: {rec.balance} {amount:+}, clamped to 0',
+                                extra={'event': 'overdraft', 'user_id': user_id, 'game': game, 'amount': amount})
+        rec.balance = max(0, rec.balance + amount)
+        leaderboard.update(user_id, old_balance, rec.balance)
+        aggregates.update_balance(old_balance, rec.balance)
+        balance_log.info(f'Balance update for {user_id}: +{amount}',
+                         extra={'event': 'balance_update', 'user_id': user_id, 'game': game, 'amount': amount})
+        record_balance(user_id, amount, rec.balance, queue_op)
+        persistence.mark_dirty('balances', 'stats', durable=True)
+
+def try_debit(user_id, amount, game=None):
+    """Take amount from user_id if they can afford it; check and debit happen without an await in between"""
+    return try_debit_many(((user_id, amount),), game)
+
+def try_debit_many(debits, game=None):
+    """All-or-nothing debit of [(user_id, amount)], e.g. both duel stakes"""
+    for user_id, amount in debits:
+        rec = get_user(user_id)
+        if rec.banned or rec.balance < amount:
+            return False
+    for user_id, amount in debits:
+        update_balance(user_id, -amount, game=game)
+    return True
+
+class UserLockManager:
+    """asyncio.Lock per user id for flows that read and write balances across awaits.
+
+    The update scheduler holds these around every update (both players for duel
+    callbacks), so handlers such as accept_duel or blackjack hit/stand never interleave
+    with another update of the same user; the locks are not reentrant, so handlers must
+    not take them again. Background code that awaits between a balance read and write
+    takes them with hold(). Locks live in a WeakValueDictionary, so a user's lock
+    disappears once nobody holds or waits on it. hold() takes several users in ascending
+    id order, so two holders of the same pair can never deadlock.
+    """
+
+    def __init__(self):
+        self.locks = weakref.WeakValueDictionary()
+
+    def lock(self, user_id):
+        lock = self.locks.get(user_id)
+        if lock is None:
+            lock = self.locks[user_id] = asyncio.Lock()
+        return lock
+
+    @contextlib.asynccontextmanager
+    async def hold(self, *user_ids):
+        locks = [self.lock(user_id) for user_id in sorted(set(user_ids))]
+        acquired = []
+        try:
+            for lock in locks:
+                await lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+user_locks = UserLockManager()
+
+# Admin IDs live in memory; admins.txt is re-read only when its mtime changes, on SIGHUP or /reload_admins
+ADMINS_FILE = 'admins.txt'
+ADMINS_WATCH_INTERVAL = float(os.getenv('ADMINS_WATCH_INTERVAL', '5'))  # seconds between mtime checks
+
+class AdminRegistry:
+    def __init__(self, path):
+        self.path = path
+        self.ids = frozenset()
+        self.mtime = None
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def reload(self, force=False):
+        """Re-read the file if it changed since the last load; returns True when the set was replaced"""
+        mtime = self._mtime()
+        if not force and mtime == self.mtime:
+            return False
+        try:
+            with open(self.path, 'r') as f:
+                ids = frozenset(int(line.strip()) for line in f if line.strip().isdigit())
+        except FileNotFoundError:
+            ids = frozenset()
+        except Exception as e:
+            logging.error(f'Error loading admins from {self.path}: {e}')
+            return False
+        self.ids = ids
+        self.mtime = mtime
+        logging.info(f'Admins loaded: {len(ids)}')
+        return True
+
+    async def watch(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.reload)
+            except Exception as e:
+                logging.error(f'Admins watch error: {e}')
+
+admin_registry = AdminRegistry(ADMINS_FILE)
+admin_registry.reload()
 
 def is_admin(user_id):
-    try:
-        with open('admins.txt', 'r') as f:
-            admins = [int(line.strip()) for line in f if line.strip().isdigit()]
-        return user_id in admins
-    except:
-        return False
+    return user_id in admin_registry.ids
+
+def start_duel(duel_id, duel):
+    """Store a started duel (one with scores) so the active duel count stays exact"""
+    pending_duels[duel_id] = duel
+    if 'scores' in duel:
+        aggregates.duel_started(duel_id)
+
+def remove_duel(key):
+    """Drop a duel or invite from pending_duels"""
+    pending_duels.pop(key, None)
+    aggregates.duel_finished(key)
 
 def log_action(action, user_id, details=''):
-    logging.info(f'{action} by {user_id}: {details}')
+    action_log.info(f'{action} by {user_id}: {details}', extra={'event': action, 'user_id': user_id})
 
 
 
@@ -280,20 +2654,22 @@ main_keyboard = ReplyKeyboardMarkup(keyboard=[
 @dp.message(Command('start'))
 async def start_handler(message: Message, state: FSMContext):
     user_id = message.from_user.id
-    if user_id in banned_users:
+    if is_banned(user_id):
         try:
             await message.answer('🚫 Вы заблокированы!', reply_markup=main_keyboard)
         except Exception as e:
             logging.error(f'Error sending ban message to {user_id}: {e}')
         return
-    get_balance(user_id)  # Ensures user in balances if new
-    if user_id not in user_info or not user_info[user_id].get('name'):
-        user_info[user_id] = {'name': message.from_user.username or 'User', 'registered': True}
-    balance = get_balance(user_id)
-    text = f'🎉 Добро пожаловать в Деп-Казино! 🎰\n💵 Баланс: ${balance}\n👤 @{user_info[user_id]["name"]}\nВыберите игру:'
+    rec = get_user(user_id)  # Registers new users
+    if not rec.name:
+        set_user_name(user_id, message.from_user.username or 'User')
+    if rec.blocked:
+        # Came back after blocking the bot: include them in broadcasts again
+        rec.blocked = False
+        persistence.mark_dirty('users', key=user_id)
+    text = f'🎉 Добро пожаловать в Деп-Казино! 🎰\n💵 Баланс: ${rec.balance}\n👤 @{rec.name}\nВыберите игру:'
     try:
         await message.answer(text, reply_markup=main_keyboard)
-        save_data()
     except Exception as e:
         logging.error(f'Error in start_handler for {user_id}: {e}')
     await state.clear()
@@ -302,12 +2678,11 @@ async def start_handler(message: Message, state: FSMContext):
 @dp.message(F.text == '💰 Баланс')
 async def balance_handler(message: Message):
     user_id = message.from_user.id
-    get_balance(user_id)
-    if user_id not in user_info or not user_info[user_id]['name']:
-        user_info[user_id] = user_info.get(user_id, {})
-        user_info[user_id]['name'] = message.from_user.username or 'User'
+    rec = get_user(user_id)
+    if not rec.name:
+        set_user_name(user_id, message.from_user.username or 'User')
     balance = get_balance(user_id)
-    text = f'💰 Ваш баланс: ${balance}\n👤 @{user_info[user_id]["name"]}'
+    text = f'💰 Ваш баланс: ${balance}\n👤 @{rec.name}\n🏅 Место в рейтинге: {leaderboard.rank(user_id)} из {len(leaderboard)}'
     try:
         await message.answer(text, reply_markup=main_keyboard)
     except Exception as e:
@@ -317,12 +2692,11 @@ async def balance_handler(message: Message):
 @dp.message(Command('balance'))
 async def balance_command(message: Message):
     user_id = message.from_user.id
-    get_balance(user_id)
-    if user_id not in user_info or not user_info[user_id]['name']:
-        user_info[user_id] = user_info.get(user_id, {})
-        user_info[user_id]['name'] = message.from_user.username or 'User'
+    rec = get_user(user_id)
+    if not rec.name:
+        set_user_name(user_id, message.from_user.username or 'User')
     balance = get_balance(user_id)
-    text = f'💰 Ваш баланс: ${balance}\n👤 @{user_info[user_id]["name"]}'
+    text = f'💰 Ваш баланс: ${balance}\n👤 @{rec.name}\n🏅 Место в рейтинге: {leaderboard.rank(user_id)} из {len(leaderboard)}'
     try:
         await message.answer(text, reply_markup=main_keyboard)
     except Exception as e:
@@ -336,13 +2710,11 @@ async def main_menu(message: Message, state: FSMContext):
         logging.error(f'Error in main_menu for {message.from_user.id}: {e}')
         # Fallback: send menu directly
         user_id = message.from_user.id
-        get_balance(user_id)
-        if user_id not in user_info or not user_info[user_id].get('name'):
-            user_info[user_id]['name'] = message.from_user.username or 'User'
-            if user_id not in user_info:
-                user_info[user_id] = {'name': message.from_user.username or 'User', 'registered': True}
+        rec = get_user(user_id)
+        if not rec.name:
+            set_user_name(user_id, message.from_user.username or 'User')
         balance = get_balance(user_id)
-        text = f'🏠 Главное меню\n💵 Баланс: ${balance}\n👤 @{user_info[user_id]["name"]}\nВыберите игру:'
+        text = f'🏠 Главное меню\n💵 Баланс: ${balance}\n👤 @{rec.name}\nВыберите игру:'
         await message.answer(text, reply_markup=main_keyboard)
         await state.clear()
         log_action('main_menu', user_id)
@@ -526,54 +2898,15 @@ async def random_duel(message: Message):
         return
     user_id = message.from_user.id
     try:
-        if any(u[0] == user_id for u in random_queue):
+        if user_id in matchmaker:
             await message.reply('Вы уже в очереди!')
             return
-        bet = 100  # Fixed bet
-        if get_balance(user_id) < bet:
-            await message.reply('Недостаточно баланса! Минимум $100.')
+        bet = RANDOM_DUEL_BET
+        chat_id = message.chat.id if message.chat.type != 'private' else None
+        if not matchmaker.join(user_id, bet, chat_id):
+            await message.reply(f'Недостаточно баланса! Минимум ${bet}.')
             return
-        random_queue.append((user_id, bet))
-        await message.reply('Вы добавлены в очередь. Ждите оппонента...')
-        save_data()
-        # Check for match
-        if len(random_queue) >= 2:
-            # Find matching bet
-            queue_copy = random_queue[:]
-            for i in range(len(queue_copy)):
-                for j in range(i+1, len(queue_copy)):
-                    id1, bet1 = queue_copy[i]
-                    id2, bet2 = queue_copy[j]
-                    if abs(bet1 - bet2) <= 10:  # Allow small bet difference for flexibility
-                        bet_avg = (bet1 + bet2) // 2
-                        # Match found
-                        random_queue[:] = [q for q in random_queue if q[0] not in (id1, id2)]
-                        # Deduct bet
-                        update_balance(id1, -bet1)
-                        update_balance(id2, -bet2)
-                        stats['total_bets'] += bet1 + bet2
-                        # Unified duel structure: player1 (initiator), player2, current_turn, scores, bet
-                        duel_id = f"{min(id1, id2)}_{max(id1, id2)}"
-                        chat_id = message.chat.id if message.chat.type != 'private' else None
-                        pending_duels[duel_id] = {
-                            'player1': id1, 'player2': id2, 'bet': bet_avg, 'chat_id': chat_id,
-                            'scores': {id1: 0, id2: 0}, 'current_turn': id1
-                        }
-                        save_data()
-                        # Get names
-                        name1 = get_opponent_name(id2)
-                        name2 = get_opponent_name(id1)
-                        # Message to player1 (turn)
-                        text1 = f"⚔️ Оппонент найден ({name1})! Ставка: ${bet_avg}\nСчёт: Вы 0 - Оппонент 0\nВаша очередь крутить слоты."
-                        keyboard1 = InlineKeyboardMarkup(inline_keyboard=[
-                            [InlineKeyboardButton(text='Крутить', callback_data=f'duel_turn_{duel_id}')]
-                        ])
-                        await bot.send_message(id1, text1, reply_markup=keyboard1)
-                        # Message to player2 (wait)
-                        text2 = f"⚔️ Оппонент найден ({name1})! Ставка: ${bet_avg}\nСчёт: Вы 0 - Оппонент 0\nЖдите своей очереди."
-                        await bot.send_message(id2, text2)
-                        return
-        save_data()
+        await message.reply(f'Вы добавлены в очередь, ставка ${bet} списана. Ждите оппонента...\n/cancel — выйти из очереди с возвратом ставки.')
     except Exception as e:
         logging.error(f'Error in random_duel for {user_id}: {e}')
         try:
@@ -581,6 +2914,38 @@ async def random_duel(message: Message):
         except:
             pass
 
+def start_random_duel(first, second):
+    """Matcher callback: both stakes are already taken, start the duel and tell the players.
+
+    Everything that can fail runs before any state changes, so the matcher can refund
+    both stakes when this raises.
+    """
+    id1, id2 = first.user_id, second.user_id
+    bet = (first.bet + second.bet) // 2
+    # Unified duel structure: player1 (waited longest, moves first), player2, current_turn, scores, bet
+    duel_id = f"{min(id1, id2)}_{max(id1, id2)}"
+    if duel_id in pending_duels:
+        raise ValueError(f'duel {duel_id} already in progress')
+    name1 = get_opponent_name(id2)
+    name2 = get_opponent_name(id1)
+    text1 = f"⚔️ Оппонент найден ({name1})! Ставка: ${bet}\nСчёт: Вы 0 - Оппонент 0\nВаша очередь крутить слоты."
+    keyboard1 = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text='Крутить', callback_data=f'duel_turn_{duel_id}')]
+    ])
+    text2 = f"⚔️ Оппонент найден ({name2})! Ставка: ${bet}\nСчёт: Вы 0 - Оппонент 0\nЖдите своей очереди."
+    stats['total_bets'] += first.bet + second.bet
+    start_duel(duel_id, {
+        'player1': id1, 'player2': id2, 'bet': bet, 'mode': 'slots', 'chat_id': second.chat_id or first.chat_id,
+        'scores': {id1: 0, id2: 0}, 'current_turn': id1
+    })
+    persistence.mark_dirty('pending_duels')
+    outbound.post(bot.send_message(id1, text1, reply_markup=keyboard1), PRIORITY_INTERACTIVE)
+    outbound.post(bot.send_message(id2, text2), PRIORITY_INTERACTIVE)
+
+def random_duel_timeout(entry):
+    log_action('random_duel_timeout', entry.user_id, f'refund {entry.bet}')
+    outbound.post(bot.send_message(entry.user_id, f'⌛ Оппонент не найден. Ставка ${entry.bet} возвращена.'), PRIORITY_INTERACTIVE)
+
 @dp.message(F.text == '⚔️ Дуэль')
 async def duel_menu(message: Message, state: FSMContext):
     global paused
@@ -598,7 +2963,8 @@ async def duel_menu(message: Message, state: FSMContext):
 
 def get_opponent_name(opp_id):
     """Get opponent name"""
-    return user_info.get(opp_id, {}).get('name', f'Пользователь ID: {opp_id}')
+    rec = users.get(opp_id)
+    return rec.name if rec is not None else f'Пользователь ID: {opp_id}'
 
 
 @dp.message(Command('duel'))
@@ -637,20 +3003,17 @@ async def duel_opponent_input(message: Message, state: FSMContext):
         elif message.entities:
             # Parse mentions from entities
             for entity in message.entities:
+                opp_id = mentioned_user_id(entity)
+                if opp_id is not None:
+                    break
                 if entity.type == 'mention':
                     username = message.text[entity.offset:entity.offset + entity.length][1:]  # Remove @
-                    for uid, info in user_info.items():
-                        if info.get('name', '').lower() == username.lower():
-                            opp_id = uid
-                            break
+                    opp_id = find_user_by_name(username)
                     if opp_id is None:
                         try:
-                            bot_chat = await bot.get_chat(f'@{username}')
-                            opp_id = bot_chat.id
-                            if opp_id not in user_info:
-                                user_info[opp_id] = {'name': username, 'registered': True}
-                                get_balance(opp_id)
-                                save_data()
+                            opp_id = await chat_lookup.resolve(username)
+                            if opp_id not in users:
+                                set_user_name(opp_id, username)
                         except Exception as e:
                             logging.error(f'Error getting mention chat for @{username}: {e}')
                             continue
@@ -659,18 +3022,12 @@ async def duel_opponent_input(message: Message, state: FSMContext):
             text = message.text.strip()
             if text.startswith('@'):
                 username = text[1:]
-                for uid, info in user_info.items():
-                    if info.get('name', '').lower() == username.lower():
-                        opp_id = uid
-                        break
+                opp_id = find_user_by_name(username)
                 if opp_id is None:
                     try:
-                        bot_chat = await bot.get_chat(f'@{username}')
-                        opp_id = bot_chat.id
-                        if opp_id not in user_info:
-                            user_info[opp_id] = {'name': username, 'registered': True}
-                            get_balance(opp_id)
-                            save_data()
+                        opp_id = await chat_lookup.resolve(username)
+                        if opp_id not in users:
+                            set_user_name(opp_id, username)
                     except Exception as e:
                         logging.error(f'Error getting chat for @{username}: {e}')
                         await message.reply(f'Пользователь @{username} не найден или недоступен.')
@@ -687,10 +3044,10 @@ async def duel_opponent_input(message: Message, state: FSMContext):
         if opp_id == user_id:
             await message.reply('Нельзя дуэлировать с собой!')
             return
-        if opp_id not in balances:
+        if opp_id not in users:
             await message.reply('Пользователь не зарегистрирован.')
             return
-        if opp_id in banned_users:
+        if is_banned(opp_id):
             await message.reply('Оппонент заблокирован!')
             return
         await state.update_data(opp_id=opp_id, chat_id=chat_id)
@@ -823,8 +3180,7 @@ async def play_slots(obj, bet: int, state: FSMContext):
         message = obj
         answer = lambda *args, **kwargs: None  # No answer for message
 
-    balance = get_balance(user_id)
-    if balance < bet:
+    if not try_debit(user_id, bet, game='slots'):
         try:
             if isinstance(obj, CallbackQuery):
                 await answer('💸 Недостаточно!')
@@ -834,7 +3190,6 @@ async def play_slots(obj, bet: int, state: FSMContext):
             logging.error(f'Error in play_slots insufficient balance for {user_id}: {e}')
         return
 
-    update_balance(user_id, -bet)
     stats['total_bets'] += bet
     symbols = ['🍒', '🍋', '🍊', '🔔', '⭐', '7️⃣']
     try:
@@ -855,14 +3210,7 @@ async def play_slots(obj, bet: int, state: FSMContext):
         return
 
     slot1, slot2, slot3 = [random.choice(symbols) for _ in range(3)]
-    try:
-        for _ in range(15):
-            temp_slots = [random.choice(symbols) for _ in range(3)]
-            anim_text = f"🎰 {' | '.join(temp_slots)} 🎰"
-            await msg.edit_text(anim_text)
-            await asyncio.sleep(0.2)
-    except Exception as e:
-        logging.error(f'Error in slots animation for {user_id}: {e}')
+    frames = [f"🎰 {' | '.join(random.choice(symbols) for _ in range(3))} 🎰" for _ in range(15)]
 
     # Payout calculation
     payout = 0
@@ -884,7 +3232,7 @@ async def play_slots(obj, bet: int, state: FSMContext):
     result_text = f"🎰 {' | '.join([slot1, slot2, slot3])} 🎰"
     if payout > 0:
         win = bet * payout
-        update_balance(user_id, win)
+        update_balance(user_id, win, game='slots')
         stats['total_wins'] += win
         result = f'🎉 Вы выиграли ${win}! (x{payout})'
     else:
@@ -892,10 +3240,6 @@ async def play_slots(obj, bet: int, state: FSMContext):
 
     new_balance = get_balance(user_id)
     full_text = f'{result_text}\n{result}\n💵 Баланс: ${new_balance}'
-    try:
-        await msg.edit_text(full_text)
-    except Exception as e:
-        logging.error(f'Error editing slots result for {user_id}: {e}')
 
     # Menu
     slots_keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -905,12 +3249,11 @@ async def play_slots(obj, bet: int, state: FSMContext):
         [InlineKeyboardButton(text='🎯 Custom', callback_data='slots_custom')],
         [InlineKeyboardButton(text='🔙 Назад', callback_data='back_main')]
     ])
-    try:
+    async def send_menu():
         await bot.send_message(user_id, 'Хотите сыграть ещё?', reply_markup=slots_keyboard)
-        await state.set_state(GameStates.waiting_bet)
-    except Exception as e:
-        logging.error(f'Error sending slots menu for {user_id}: {e}')
 
+    # Result is settled; the spin plays out in the background and ends with the menu
+    animations.animate(msg, frames, 0.2, full_text, after=send_menu)
     await state.clear()
     try:
         await answer()
@@ -1015,7 +3358,7 @@ async def duel_bet_input(message: Message, state: FSMContext):
         await message.reply(f'Приглашение отправлено {my_name}!')
         # Store pending invite
         pending_duels[user_id] = {'opp': opp_id, 'bet': bet, 'chat_id': chat_id}
-        save_data()
+        persistence.mark_dirty('pending_duels')
         await state.clear()
     except ValueError:
         await message.reply('Введите число!')
@@ -1214,7 +3557,7 @@ async def admin_add_money_input(message: Message, state: FSMContext):
         old_balance = get_balance(user_id)
         update_balance(user_id, change)
         new_balance = get_balance(user_id)
-        name = user_info.get(user_id, {}).get('name', 'User')
+        name = user_name(user_id)
         await message.reply(f'Баланс @{name} (ID {user_id}): {old_balance} -> {new_balance} (изменение: {change})$')
     except ValueError as e:
         await message.reply(f'Ошибка ввода: {str(e)}\nПример: 12345 +100 или 12345+100')
@@ -1222,28 +3565,276 @@ async def admin_add_money_input(message: Message, state: FSMContext):
         await message.reply(f'Неожиданная ошибка: {str(e)}')
     await state.clear()
 
-@dp.callback_query(F.data == 'admin_users')
+ADMIN_USERS_PAGE_SIZE = 20
+
+@dp.callback_query(F.data.startswith('admin_users'))
 async def admin_users(callback: CallbackQuery):
-    if not balances:
+    if not is_admin(callback.from_user.id):
+        await callback.answer('🚫 Нет доступа!')
+        return
+    # admin_users -> first page, admin_users_<n> -> page n
+    try:
+        page = int(callback.data.rsplit('_', 1)[1]) if callback.data != 'admin_users' else 0
+    except ValueError:
+        page = 0
+    pages = max(1, (len(leaderboard) + ADMIN_USERS_PAGE_SIZE - 1) // ADMIN_USERS_PAGE_SIZE)
+    page = min(max(page, 0), pages - 1)
+    nav = []
+    if not users:
         text = '👥 Нет пользователей.'
     else:
-        text = '👥 Пользователи (sorted by balance):\n'
-        for uid, bal in sorted(balances.items(), key=lambda x: x[1], reverse=True):
-            name = user_info.get(uid, {}).get('name', 'User')
-            text += f'ID: {uid} | @{name} | 💵 ${bal}\n'
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text='🔙 Админ', callback_data='admin_menu')]])
+        offset = page * ADMIN_USERS_PAGE_SIZE
+        text = f'👥 Пользователи (sorted by balance), стр. {page + 1}/{pages}:\n'
+        for place, (uid, bal) in enumerate(leaderboard.top(ADMIN_USERS_PAGE_SIZE, offset), offset + 1):
+            name = user_name(uid)
+            text += f'{place}. ID: {uid} | @{name} | 💵 ${bal}\n'
+        if page > 0:
+            nav.append(InlineKeyboardButton(text='◀️', callback_data=f'admin_users_{page - 1}'))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton(text='▶️', callback_data=f'admin_users_{page + 1}'))
+    rows = [nav] if nav else []
+    rows.append([InlineKeyboardButton(text='🔙 Админ', callback_data='admin_menu')])
+    keyboard = InlineKeyboardMarkup(inline_keyboard=rows)
     await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
 @dp.callback_query(F.data == 'admin_stats')
 async def admin_stats(callback: CallbackQuery):
     total_rtp = (stats['total_wins'] / stats['total_bets'] * 100) if stats['total_bets'] > 0 else 0
-    top_balance = max(balances.values()) if balances else 0
-    text = f'📊 Статистика:\n💰 Общие ставки: ${stats["total_bets"]}\n🏆 Общие выигрыши: ${stats["total_wins"]}\n📈 RTP: {total_rtp:.1f}%\n👥 Активных пользователей: {len(balances)}\n👑 Топ баланс: ${top_balance}\n🎯 Выигрышей: {len([b for b in balances.values() if b > 10000])}'
+    agg = aggregates.snapshot()
+    text = f'📊 Статистика:\n💰 Общие ставки: ${stats["total_bets"]}\n🏆 Общие выигрыши: ${stats["total_wins"]}\n📈 RTP: {total_rtp:.1f}%\n👥 Активных пользователей: {agg["users"]}\n👑 Топ баланс: ${agg["max"]}\n🎯 Выигрышей: {agg["above_start"]}\n💵 Всего на балансах: ${agg["total"]}\n⚔️ Активных дуэлей: {agg["active_duels"]}'
+    text += '\n📊 Распределение балансов:\n' + '\n'.join(f'  ${label}: {n}' for label, n in agg['histogram'])
     keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text='🔙 Админ', callback_data='admin_menu')]])
     await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
+@dp.message(Command('reload_admins'))
+async def reload_admins_handler(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer('🚫 Нет доступа!')
+        return
+    await asyncio.to_thread(admin_registry.reload, True)
+    await message.reply(f'✅ Список админов перечитан: {len(admin_registry.ids)}')
+    log_action('reload_admins', message.from_user.id)
+
+@dp.message(Command('logs_range'))
+async def logs_range_handler(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer('🚫 Нет доступа!')
+        return
+    # /logs_range 14:00 14:05  or  /logs_range 2024-05-01 14:00 2024-05-01 14:05
+    parts = message.text.split()[1:]
+    try:
+        half = len(parts) // 2
+        start = parse_log_time(' '.join(parts[:half]))
+        end = parse_log_time(' '.join(parts[half:]))
+    except ValueError:
+        await message.reply('Формат: /logs_range 14:00 14:05')
+        return
+    lines = await asyncio.to_thread(file_log_handler.read_range, start, end, 200)
+    text = '\n'.join(lines)[-3500:]
+    await message.reply(f'📝 Логи ({len(lines)} строк):\n{text or "Нет логов"}')
+
+# Broadcasts: background jobs with bounded concurrency under a global rate, resumable after restarts
+BROADCAST_FILE = 'broadcasts.json'
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '10'))
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))  # messages per second, below Telegram's ~30/s
+BROADCAST_PROGRESS_INTERVAL = 3  # seconds between progress edits
+
+class BroadcastEngine:
+    """Runs broadcast jobs persisted in BROADCAST_FILE.
+
+    A job keeps the recipient list fixed at creation and a cursor: every recipient
+    before it has been handled. After a restart the job resumes at the cursor. The cursor
+    is checkpointed every BROADCAST_PROGRESS_INTERVAL seconds and when the job is stopped,
+    so after a clean shutdown at most the last BROADCAST_CONCURRENCY in-flight recipients
+    can get the message twice; after a crash, also those sent since the last checkpoint.
+    The recipient list is written once, to its own file, when the job starts; the
+    periodic checkpoint only rewrites the small jobs file with cursors and counters.
+    """
+
+    KEEP_FINISHED = 20  # finished jobs kept in the file for reference
+
+    def __init__(self, path, concurrency, rate):
+        self.path = path
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, rate)
+        self.jobs = {}  # job id -> dict (persisted)
+        self.recipients = {}  # job id -> recipient list of a running job (persisted once, see recipients_path)
+        self.tasks = {}
+        self.next_id = 1
+        self.save_seq = 0
+        self.saved_seq = 0
+        self.write_lock = threading.Lock()
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            self.jobs = {job['id']: job for job in data.get('jobs', [])}
+            self.next_id = data.get('next_id', 1)
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            logging.error(f'Error loading {path}: {e}')
+        for job in self.jobs.values():
+            if job['status'] != 'running':
+                continue
+            try:
+                with open(self.recipients_path(job['id']), 'r') as f:
+                    self.recipients[job['id']] = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error(f'Error loading recipients of broadcast {job["id"]}: {e}')
+                job['status'] = 'done'
+
+    def recipients_path(self, job_id):
+        return f'{self.path}.{job_id}.recipients'
+
+    def _write(self, seq, jobs):
+        """Runs in a worker thread; a checkpoint older than the one on disk is dropped"""
+        with self.write_lock:
+            if seq <= self.saved_seq:
+                return
+            payload = json.dumps({'next_id': self.next_id, 'jobs': jobs}, ensure_ascii=False).encode('utf-8')
+            atomic_write(self.path, payload)
+            self.saved_seq = seq
+
+    async def save(self):
+        """Checkpoint cursors and counters; the copies are taken on the loop, encoding and I/O run in a thread"""
+        self.save_seq += 1
+        jobs = [dict(job) for job in self.jobs.values()]
+        try:
+            await asyncio.to_thread(self._write, self.save_seq, jobs)
+        except Exception as e:
+            logging.error(f'Failed to save broadcasts: {e}')
+
+    def checkpoint(self):
+        """Blocking save for the stop path, which must not wait for another thread hop"""
+        self.save_seq += 1
+        try:
+            self._write(self.save_seq, [dict(job) for job in self.jobs.values()])
+        except Exception as e:
+            logging.error(f'Failed to save broadcasts: {e}')
+
+    async def stop(self):
+        """Cancel running jobs at shutdown; each one checkpoints its cursor on the way out"""
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def create(self, admin_id, text, progress_message):
+        recipients = [uid for uid, rec in users.items() if not rec.blocked]
+        job = {
+            'id': self.next_id, 'admin_id': admin_id, 'text': text, 'total': len(recipients),
+            'cursor': 0, 'sent': 0, 'failed': 0, 'blocked': 0, 'status': 'running',
+            'progress_chat': progress_message.chat.id, 'progress_message': progress_message.message_id,
+        }
+        self.next_id += 1
+        await asyncio.to_thread(atomic_write, self.recipients_path(job['id']), json.dumps(recipients).encode('utf-8'))
+        self.recipients[job['id']] = recipients
+        self.jobs[job['id']] = job
+        await self.save()
+        self.start(job)
+        return job
+
+    def start(self, job):
+        self.tasks[job['id']] = asyncio.create_task(self._run(job))
+
+    def resume(self):
+        for job in self.jobs.values():
+            if job['status'] == 'running' and job['id'] not in self.tasks:
+                logging.info(f'Resuming broadcast {job["id"]} at {job["cursor"]}/{job["total"]}')
+                self.start(job)
+
+    def progress_text(self, job):
+        total = job['total']
+        state = '✅ Рассылка завершена' if job['status'] == 'done' else '📢 Рассылка идёт'
+        return (f'{state}: {job["cursor"]}/{total}\n'
+                f'✉️ Отправлено: {job["sent"]}, ❌ Ошибок: {job["failed"]}, 🚫 Заблокировали бота: {job["blocked"]}')
+
+    async def _take_token(self):
+        while not self.bucket.ready():
+            await asyncio.sleep(self.bucket.delay())
+        self.bucket.take()
+
+    async def _send(self, job, user_id):
+        rec = users.get(user_id)
+        if rec is not None and rec.blocked:
+            job['blocked'] += 1
+            return
+        for _ in range(3):
+            await self._take_token()
+            try:
+                await bot.send_message(user_id, job['text'])
+                job['sent'] += 1
+                return
+            except TelegramRetryAfter as e:
+                # Flood control applies to the whole bot: drain the bucket for retry_after
+                self.bucket.penalize(e.retry_after)
+            except TelegramForbiddenError:
+                get_user(user_id).blocked = True
+                persistence.mark_dirty('users', key=user_id)
+                job['blocked'] += 1
+                return
+            except Exception as e:
+                logging.error(f'Failed to send broadcast {job["id"]} to {user_id}: {e}')
+                break
+        job['failed'] += 1
+
+    async def _report(self, job):
+        try:
+            await bot.edit_message_text(self.progress_text(job), chat_id=job['progress_chat'], message_id=job['progress_message'])
+        except TelegramBadRequest:
+            pass  # not modified / message gone
+        except Exception as e:
+            logging.error(f'Error updating broadcast {job["id"]} progress: {e}')
+
+    async def _run(self, job):
+        outbound_priority.set(PRIORITY_BULK)  # inherited by the workers below
+        recipients = self.recipients[job['id']]
+        next_index = job['cursor']
+        done = set()  # finished indexes past the cursor
+
+        async def worker():
+            nonlocal next_index
+            while next_index < len(recipients):
+                i = next_index
+                next_index += 1
+                await self._send(job, recipients[i])
+                done.add(i)
+                while job['cursor'] in done:
+                    done.remove(job['cursor'])
+                    job['cursor'] += 1
+
+        async def reporter():
+            while True:
+                await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+                await self.save()
+                await self._report(job)
+
+        progress = asyncio.create_task(reporter())
+        try:
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        except asyncio.CancelledError:
+            self.checkpoint()  # resume exactly here instead of at the last periodic checkpoint
+            raise
+        finally:
+            progress.cancel()
+        job['status'] = 'done'
+        finished = [j['id'] for j in self.jobs.values() if j['status'] == 'done']
+        for old_id in finished[:-self.KEEP_FINISHED]:
+            del self.jobs[old_id]
+        await self.save()
+        self.recipients.pop(job['id'], None)
+        try:
+            await asyncio.to_thread(os.remove, self.recipients_path(job['id']))
+        except OSError as e:
+            logging.error(f'Failed to remove recipients of broadcast {job["id"]}: {e}')
+        await self._report(job)
+        self.tasks.pop(job['id'], None)
+        logging.info(f'Broadcast {job["id"]} by {job["admin_id"]} done: {job["sent"]} sent, {job["failed"]} failed, {job["blocked"]} blocked')
+
+broadcasts = BroadcastEngine(BROADCAST_FILE, BROADCAST_CONCURRENCY, BROADCAST_RATE)
+
 @dp.message(Command('broadcast'))
 async def broadcast_handler(message: Message, state: FSMContext):
     if not is_admin(message.from_user.id):
@@ -1257,32 +3848,32 @@ async def broadcast_send(message: Message, state: FSMContext):
     if not is_admin(message.from_user.id):
         await state.clear()
         return
-    broadcast_msg = message.text
-    sent_count = 0
-    failed_count = 0
-    for user_id in list(user_info.keys()):
-        try:
-            await bot.send_message(user_id, broadcast_msg)
-            sent_count += 1
-        except Exception as e:
-            logging.error(f'Failed to send broadcast to {user_id}: {e}')
-            failed_count += 1
-    await message.answer(f'📢 Рассылка завершена: {sent_count} отправлено, {failed_count} ошибок.', reply_markup=main_keyboard)
     await state.clear()
-    logging.info(f'Broadcast sent by {message.from_user.id}: {sent_count} success, {failed_count} fail')
+    progress = await message.answer('📢 Рассылка запускается...')
+    job = await broadcasts.create(message.from_user.id, message.text, progress)
+    logging.info(f'Broadcast {job["id"]} started by {message.from_user.id}: {job["total"]} recipients')
+
+@dp.callback_query(F.data == 'admin_broadcast')
+async def admin_broadcast(callback: CallbackQuery, state: FSMContext):
+    if not is_admin(callback.from_user.id):
+        await callback.answer('🚫 Нет доступа!')
+        return
+    await callback.message.edit_text('📢 Введите сообщение для рассылки всем пользователям:')
+    await state.set_state(GameStates.waiting_broadcast)
+    await callback.answer()
 
 @dp.callback_query(F.data == 'admin_top')
 async def admin_top_users(callback: CallbackQuery):
     if not is_admin(callback.from_user.id):
         await callback.answer('🚫 Нет доступа!')
         return
-    if not balances:
+    if not users:
         text = '🏆 Нет пользователей.'
     else:
-        top_users = sorted(balances.items(), key=lambda x: x[1], reverse=True)[:10]
+        top_users = leaderboard.top(10)
         text = '🏆 Топ 10 пользователей по балансу:\n\n'
         for i, (uid, bal) in enumerate(top_users, 1):
-            name = user_info.get(uid, {}).get('name', f'User{uid}')
+            name = user_name(uid, f'User{uid}')
             text += f'{i}. @{name} (ID: {uid}) - ${bal}\n'
     keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text='🔙 Админ', callback_data='admin_menu')]])
     await callback.message.edit_text(text, reply_markup=keyboard)
@@ -1306,7 +3897,7 @@ async def admin_reset_balance(message: Message, state: FSMContext):
         old_balance = get_balance(user_id)
         change = 10000 - old_balance
         update_balance(user_id, change)
-        name = user_info.get(user_id, {}).get('name', 'User')
+        name = user_name(user_id)
         await message.reply(f'🔄 Баланс @{name} (ID {user_id}) сброшен: {old_balance} -> 10000$', reply_markup=main_keyboard)
         logging.info(f'Balance reset for {user_id} by {message.from_user.id} to 10000')
     except ValueError:
@@ -1322,7 +3913,7 @@ async def admin_pause_games(callback: CallbackQuery):
         return
     global paused
     paused = not paused
-    save_data()
+    persistence.mark_dirty('paused')
     status = '⏸️ Игры приостановлены' if paused else '▶️ Игры возобновлены'
     await callback.message.edit_text(f'{status} для всех пользователей.')
     logging.info(f'Games paused toggled to {paused} by {callback.from_user.id}')
@@ -1355,30 +3946,26 @@ async def admin_ban(callback: CallbackQuery, state: FSMContext):
 async def admin_ban_input(message: Message, state: FSMContext):
     try:
         user_id = int(message.text)
-        if user_id in banned_users:
-            banned_users.remove(user_id)
-            await message.reply(f'{user_id} разбанен.')
-            save_data()
-        else:
-            banned_users.add(user_id)
+        rec = get_user(user_id)
+        rec.banned = not rec.banned
+        persistence.mark_dirty('users', key=user_id)
+        if rec.banned:
             await message.reply(f'{user_id} забанен.')
-            save_data()
-            save_data()
+        else:
+            await message.reply(f'{user_id} разбанен.')
     except:
         await message.reply('Неверный ID!')
     await state.clear()
 
 @dp.callback_query(F.data == 'admin_queue')
 async def admin_queue(callback: CallbackQuery):
-    random_queue.clear()
-    save_data()
-    await callback.answer('🗑 Очередь очищена!')
+    count = matchmaker.clear()
+    await callback.answer(f'🗑 Очередь очищена! Возвращено ставок: {count}')
 
 @dp.callback_query(F.data == 'admin_logs')
 async def admin_logs(callback: CallbackQuery):
     try:
-        with open('bot.log', 'r') as f:
-            logs = f.read()[-1000:]
+        logs = '\n'.join(ring_buffer.records(limit=20))[-1000:]
         await callback.message.edit_text(f'📝 Логи:\n{logs or "Нет логов"}')
     except:
         await callback.message.edit_text('Ошибка чтения логов.')
@@ -1413,7 +4000,7 @@ async def admin_feedback(callback: CallbackQuery):
 async def back_main(callback: CallbackQuery, state: FSMContext):
     await state.clear()
     user_id = callback.from_user.id
-    if user_id in banned_users:
+    if is_banned(user_id):
         try:
             await callback.message.delete()
         except:
@@ -1421,12 +4008,11 @@ async def back_main(callback: CallbackQuery, state: FSMContext):
         await bot.send_message(user_id, '🚫 Вы заблокированы!', reply_markup=main_keyboard)
         await callback.answer()
         return
-    get_balance(user_id)
-    if user_id not in user_info or not user_info[user_id]['name']:
-        user_info[user_id] = user_info.get(user_id, {})
-        user_info[user_id]['name'] = callback.from_user.username or 'User'
+    rec = get_user(user_id)
+    if not rec.name:
+        set_user_name(user_id, callback.from_user.username or 'User')
     balance = get_balance(user_id)
-    text = f'🎉 Добро пожаловать в Деп-Казино! 🎰\n💵 Баланс: ${balance}\n👤 @{user_info[user_id]["name"]}\nВыберите игру:'
+    text = f'🎉 Добро пожаловать в Деп-Казино! 🎰\n💵 Баланс: ${balance}\n👤 @{rec.name}\nВыберите игру:'
     try:
         await callback.message.delete()
     except:
@@ -1439,21 +4025,21 @@ async def back_main(callback: CallbackQuery, state: FSMContext):
 @dp.message(F.text == '🎁 Бонус')
 async def daily_bonus(message: Message):
     user_id = message.from_user.id
-    now = datetime.now()
-    last = last_daily.get(user_id, now - timedelta(days=2))
-    if now - last > timedelta(days=1):
+    rec = get_user(user_id)
+    now = time.time()
+    if now - rec.last_daily > DAILY_BONUS_COOLDOWN:
         old_balance = get_balance(user_id)
-        update_balance(user_id, 200)
-        last_daily[user_id] = now
-        save_data()
+        update_balance(user_id, 200, game='bonus')
+        rec.last_daily = int(now)
+        persistence.mark_dirty('users', key=user_id)
         new_balance = get_balance(user_id)
-        name = user_info.get(user_id, {}).get('name', 'User')
+        name = user_name(user_id)
         try:
             await message.answer(f'🎁 +200$ ежедневно! 💵\nБаланс @{name}: {old_balance} -> {new_balance}', reply_markup=main_keyboard)
         except Exception as e:
             logging.error(f'Error in daily bonus success for {user_id}: {e}')
     else:
-        remaining = timedelta(days=1) - (now - last)
+        remaining = timedelta(seconds=DAILY_BONUS_COOLDOWN - (now - rec.last_daily))
         hours = remaining.seconds // 3600
         mins = (remaining.seconds % 3600) // 60
         try:
@@ -1471,12 +4057,11 @@ async def cancel_handler(message: Message, state: FSMContext):
     user_id = message.from_user.id
     current_state = await state.get_state()
     await state.clear()
-    # Remove from random queue
-    global random_queue
-    random_queue = [q for q in random_queue if q[0] != user_id]
+    # Remove from random queue, refunding the stake
+    matchmaker.leave(user_id)
     # Cancel pending duel invite
     if user_id in pending_duels and isinstance(pending_duels[user_id], dict) and 'opp' in pending_duels[user_id]:
-        del pending_duels[user_id]
+        remove_duel(user_id)
     # Cancel PM if in PM states
     if current_state in [State(GameStates.waiting_pm_recipient), State(GameStates.waiting_pm_message)]:
         pm_sessions.pop(user_id, None)
@@ -1485,21 +4070,20 @@ async def cancel_handler(message: Message, state: FSMContext):
         await message.reply('❌ Дуэль отменена.\nВернулись в главное меню.', reply_markup=main_keyboard)
     else:
         await message.reply('❌ Действие отменено.\nВернулись в главное меню.', reply_markup=main_keyboard)
-    save_data()
+    persistence.mark_dirty('random_queue', 'pending_duels')
 
 @dp.callback_query(F.data == 'cancel_duel_input')
 async def cancel_duel_input(callback: CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     await state.clear()
     # Remove from queue/pending as in cancel_handler
-    global random_queue
-    random_queue = [q for q in random_queue if q[0] != user_id]
+    matchmaker.leave(user_id)
     if user_id in pending_duels and isinstance(pending_duels[user_id], dict) and 'opp' in pending_duels[user_id]:
-        del pending_duels[user_id]
-    save_data()
+        remove_duel(user_id)
+    persistence.mark_dirty('random_queue', 'pending_duels')
     await callback.message.edit_text('❌ Дуэль отменена.')
     balance = get_balance(user_id)
-    text = f'🎉 Добро пожаловать в Деп-Казино! 🎰\n💵 Баланс: ${balance}\n👤 @{user_info[user_id]["name"]}\nВыберите игру:'
+    text = f'🎉 Добро пожаловать в Деп-Казино! 🎰\n💵 Баланс: ${balance}\n👤 @{user_name(user_id, "")}\nВыберите игру:'
     await bot.send_message(user_id, text, reply_markup=main_keyboard)
     await callback.answer()
 
@@ -1522,22 +4106,21 @@ async def pm_start(message: Message, state: FSMContext):
 async def pm_recipient_input(message: Message, state: FSMContext):
     user_id = message.from_user.id
     text = message.text.strip()
-    if text.startswith('@'):
-        username = text[1:]
-        opp_id = None
-        # Search in user_info
-        for uid, info in user_info.items():
-            if info.get('name', '').lower() == username.lower():
-                opp_id = uid
-                break
+    opp_id = None
+    for entity in message.entities or []:
+        opp_id = mentioned_user_id(entity)
+        if opp_id is not None:
+            username = user_name(opp_id, '') or message.text[entity.offset:entity.offset + entity.length]
+            break
+    if opp_id is not None or text.startswith('@'):
+        if opp_id is None:
+            username = text[1:]
+            opp_id = find_user_by_name(username)
         if opp_id is None:
             try:
-                chat = await bot.get_chat(f'@{username}')
-                opp_id = chat.id
-                if opp_id not in user_info:
-                    user_info[opp_id] = {'name': username, 'registered': True}
-                    get_balance(opp_id)
-                    save_data()
+                opp_id = await chat_lookup.resolve(username)
+                if opp_id not in users:
+                    set_user_name(opp_id, username)
             except Exception as e:
                 logging.error(f'Error getting PM chat for @{username}: {e}')
                 await message.reply(f'Пользователь @{username} не найден.')
@@ -1545,7 +4128,7 @@ async def pm_recipient_input(message: Message, state: FSMContext):
         if opp_id == user_id:
             await message.reply('Нельзя писать себе!')
             return
-        if opp_id in banned_users:
+        if is_banned(opp_id):
             await message.reply('Пользователь заблокирован.')
             return
         # Start PM session
@@ -1605,18 +4188,11 @@ async def feedback_submit(message: Message, state: FSMContext):
         'replied': False,
         'reply': ''
     })
-    save_data()
-    # Notify all admins
-    try:
-        with open('admins.txt', 'r') as f:
-            admins = [int(line.strip()) for line in f if line.strip().isdigit()]
-        for admin_id in admins:
-            try:
-                await bot.send_message(admin_id, f'🆕 Новый отзыв от @{username} (ID: {user_id}):\n\n{text}\n\nОтветить: /feedback_reply {user_id}')
-            except Exception as e:
-                logging.error(f'Failed to notify admin {admin_id}: {e}')
-    except Exception as e:
-        logging.error(f'Error loading admins for notification: {e}')
+    persistence.mark_dirty('feedbacks')
+    # Notify all admins in the background, behind interactive replies
+    for admin_id in admin_registry.ids:
+        outbound.post(bot.send_message(admin_id, f'🆕 Новый отзыв от @{username} (ID: {user_id}):\n\n{text}\n\nОтветить: /feedback_reply {user_id}'),
+                      PRIORITY_ANNOUNCE)
     balance = get_balance(user_id)
     await message.answer(f'✅ Спасибо за отзыв! Ваш баланс: ${balance}', reply_markup=main_keyboard)
     await state.clear()
@@ -1658,7 +4234,7 @@ async def admin_wait_feedback_reply(message: Message, state: FSMContext):
     if fb:
         fb['reply'] = reply_text
         fb['replied'] = True
-        save_data()
+        persistence.mark_dirty('feedbacks')
         try:
             await bot.send_message(user_id, f'📩 Ответ от администратора на ваш отзыв:\n\n{reply_text}\n\nСпасибо за обратную связь!')
             await message.answer(f'✅ Ответ отправлен пользователю {user_id}.')
@@ -1671,14 +4247,12 @@ async def admin_wait_feedback_reply(message: Message, state: FSMContext):
 
 async def play_roulette(message: Message, bet: int, roulette_type: str, multiplier: int, bet_number=None):
     user_id = message.from_user.id
-    balance = get_balance(user_id)
-    if balance < bet:
+    if not try_debit(user_id, bet, game='roulette'):
         try:
             await message.reply('💸 Недостаточно средств!')
         except Exception as e:
             logging.error(f'Error in roulette insufficient for {user_id}: {e}')
         return
-    update_balance(user_id, -bet)
     stats['total_bets'] += bet
     try:
         await message.reply('🎡 Крутим рулетку...')
@@ -1689,14 +4263,7 @@ async def play_roulette(message: Message, bet: int, roulette_type: str, multipli
     except Exception as e:
         logging.error(f'Error sending roulette loading for {user_id}: {e}')
         return
-    # Spin animation
-    try:
-        for _ in range(10):
-            temp_num = random.randint(0, 36)
-            await msg.edit_text(f'🎡 {temp_num}')
-            await asyncio.sleep(0.3)
-    except Exception as e:
-        logging.error(f'Error in roulette animation for {user_id}: {e}')
+    frames = [f'🎡 {random.randint(0, 36)}' for _ in range(10)]
     # Final number
     final_num = random.randint(0, 36)
     win = False
@@ -1719,17 +4286,13 @@ async def play_roulette(message: Message, bet: int, roulette_type: str, multipli
         else:
             result_text += f'\n😔 Проигрыш на {roulette_type}.'
     if win:
-        update_balance(user_id, win_amount)
+        update_balance(user_id, win_amount, game='roulette')
         stats['total_wins'] += win_amount
         result = f'🎉 Вы выиграли ${win_amount}!'
     else:
         result = f'😔 Потеряли ${bet}.'
     new_balance = get_balance(user_id)
     full_text = f'{result_text}\n{result}\n💵 Баланс: ${new_balance}'
-    try:
-        await msg.edit_text(full_text)
-    except Exception as e:
-        logging.error(f'Error editing roulette result for {user_id}: {e}')
     # Send new menu
     roulette_keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text='🔴 Красное (x2)', callback_data='roulette_red')],
@@ -1739,10 +4302,10 @@ async def play_roulette(message: Message, bet: int, roulette_type: str, multipli
         [InlineKeyboardButton(text='🎯 Число (x18)', callback_data='roulette_number')],
         [InlineKeyboardButton(text='🔙 Назад', callback_data='back_main')]
     ])
-    try:
+    async def send_menu():
         await bot.send_message(user_id, 'Хотите сыграть ещё?', reply_markup=roulette_keyboard)
-    except Exception as e:
-        logging.error(f'Error sending roulette menu for {user_id}: {e}')
+
+    animations.animate(msg, frames, 0.3, full_text, after=send_menu)
 
 @dp.callback_query(F.data == 'roulette_menu')
 async def roulette_menu_callback(callback: CallbackQuery, state: FSMContext):
@@ -1789,14 +4352,12 @@ async def start_blackjack(message_or_callback, bet: int, state: FSMContext):
         user_id = message_or_callback.from_user.id
     else:
         user_id = message_or_callback.from_user.id
-    balance = get_balance(user_id)
-    if balance < bet:
+    if not try_debit(user_id, bet, game='blackjack'):
         if hasattr(message_or_callback, 'reply'):
             await message_or_callback.reply('💸 Недостаточно!')
         else:
             await message_or_callback.message.reply('💸 Недостаточно!')
         return
-    update_balance(user_id, -bet)
     stats['total_bets'] += bet
     player_hand = [await get_card(), await get_card()]
     dealer_hand = [await get_card(), await get_card()]  # Dealer second card hidden
@@ -1809,11 +4370,11 @@ async def start_blackjack(message_or_callback, bet: int, state: FSMContext):
         dealer_value = hand_value(dealer_hand)
         if dealer_value == 21:
             # Push
-            update_balance(user_id, bet)
+            update_balance(user_id, bet, game='blackjack')
             text += '\nНичья! Возврат ставки.'
         else:
             win_amount = int(bet * 1.5)
-            update_balance(user_id, bet + win_amount)
+            update_balance(user_id, bet + win_amount, game='blackjack')
             stats['total_wins'] += bet + win_amount
             text += f'\nБлэкджек! Вы выиграли ${bet + win_amount}!'
         new_balance = get_balance(user_id)
@@ -1878,11 +4439,11 @@ async def blackjack_stand(callback: CallbackQuery, state: FSMContext):
     text = f'♠️ Ваша рука: {data["player_hand"]} (сумма: {player_value})\nДилер: {dealer_hand} (сумма: {dealer_value})'
     if dealer_value > 21 or player_value > dealer_value:
         win_amount = bet
-        update_balance(user_id, win_amount * 2)  # Return bet + win
+        update_balance(user_id, win_amount * 2, game='blackjack')  # Return bet + win
         stats['total_wins'] += win_amount
         result = f'Вы выиграли ${win_amount}!'
     elif player_value == dealer_value:
-        update_balance(user_id, bet)  # Push
+        update_balance(user_id, bet, game='blackjack')  # Push
         result = 'Ничья! Возврат ставки.'
     else:
         result = 'Дилер выиграл.'
@@ -1922,14 +4483,12 @@ async def blackjack_menu_callback(callback: CallbackQuery, state: FSMContext):
 
 async def play_sport(message: Message, bet: int, sport_type: str, choice: str):
     user_id = message.from_user.id
-    balance = get_balance(user_id)
-    if balance < bet:
+    if not try_debit(user_id, bet, game='sport'):
         try:
             await message.reply('💸 Недостаточно!')
         except Exception as e:
             logging.error(f'Error in sport insufficient for {user_id}: {e}')
         return
-    update_balance(user_id, -bet)
     stats['total_bets'] += bet
     try:
         await message.reply('⚽ Матч начинается...')
@@ -1940,13 +4499,7 @@ async def play_sport(message: Message, bet: int, sport_type: str, choice: str):
     except Exception as e:
         logging.error(f'Error sending sport loading for {user_id}: {e}')
         return
-    # Animation
-    try:
-        for _ in range(5):
-            await msg.edit_text('⚽ Игра...')
-            await asyncio.sleep(0.5)
-    except Exception as e:
-        logging.error(f'Error in sport animation for {user_id}: {e}')
+    frames = ['⚽ Игра...'] * 5
 
     if sport_type == 'team':
         # Simulate with draw: ~33% each
@@ -1955,12 +4508,12 @@ async def play_sport(message: Message, bet: int, sport_type: str, choice: str):
         outcome = random.choices(outcomes, weights=weights)[0]
         multiplier = 2
         if outcome == 'draw':
-            update_balance(user_id, bet)  # Refund
+            update_balance(user_id, bet, game='sport')  # Refund
             result = f'🤝 Ничья! Ставка возвращена (${bet}).'
             display_outcome = 'Ничья'
         elif outcome == choice:
             win_amount = bet * multiplier
-            update_balance(user_id, win_amount)
+            update_balance(user_id, win_amount, game='sport')
             stats['total_wins'] += win_amount
             result = f'🎉 Команда {choice.upper()} победила! Вы выиграли ${win_amount}!'
             display_outcome = f'Команда {choice.upper()}'
@@ -1984,7 +4537,7 @@ async def play_sport(message: Message, bet: int, sport_type: str, choice: str):
         multiplier = 1.8
         win_amount = int(bet * multiplier)
         if (choice == 'over' and is_over) or (choice == 'under' and not is_over):
-            update_balance(user_id, win_amount)
+            update_balance(user_id, win_amount, game='sport')
             stats['total_wins'] += win_amount
             result = f'🎉 {choice.upper()} 2.5! Вы выиграли ${win_amount}!'
             display_outcome = f'{total_goals} голов ({goals_a}:{goals_b})'
@@ -2000,14 +4553,10 @@ async def play_sport(message: Message, bet: int, sport_type: str, choice: str):
             [InlineKeyboardButton(text='🔙 Назад', callback_data='back_main')]
         ])
 
-    try:
-        await msg.edit_text(full_text)
-    except Exception as e:
-        logging.error(f'Error editing sport result for {user_id}: {e}')
-    try:
+    async def send_menu():
         await bot.send_message(user_id, 'Хотите сыграть ещё?', reply_markup=sport_keyboard)
-    except Exception as e:
-        logging.error(f'Error sending sport menu for {user_id}: {e}')
+
+    animations.animate(msg, frames, 0.5, full_text, after=send_menu)
 
 def get_card_poker():
     rank = random.randint(2, 14)
@@ -2063,14 +4612,12 @@ async def play_poker(message_or_callback, bet: int, state: FSMContext):
         msg = message_or_callback
         answer = lambda *args, **kwargs: None
     try:
-        balance = get_balance(user_id)
-        if balance < bet:
+        if not try_debit(user_id, bet, game='poker'):
             if isinstance(message_or_callback, CallbackQuery):
                 await answer('💸 Недостаточно!')
             else:
                 await msg.reply('💸 Недостаточно!')
             return
-        update_balance(user_id, -bet)
         stats['total_bets'] += bet
         hand = [get_card_poker() for _ in range(5)]
         hand_value = evaluate_poker_hand(hand)
@@ -2081,7 +4628,7 @@ async def play_poker(message_or_callback, bet: int, state: FSMContext):
         base_chance = max(0.1, 0.5 - (multiplier * 0.005))
         if random.random() < base_chance:
             win_amount = bet * multiplier
-            update_balance(user_id, win_amount)
+            update_balance(user_id, win_amount, game='poker')
             stats['total_wins'] += win_amount
             result = f'🎉 Рука: {hand_value} (x{multiplier})! +${win_amount}'
         else:
@@ -2096,7 +4643,7 @@ async def play_poker(message_or_callback, bet: int, state: FSMContext):
             [InlineKeyboardButton(text='♦️ Снова', callback_data='poker_menu')],
             [InlineKeyboardButton(text='🔙 Главное', callback_data='back_main')]
         ])
-        await bot.send_message(user_id, 'Ещё?', reply_markup=keyboard)
+        outbound.post(bot.send_message(user_id, 'Ещё?', reply_markup=keyboard), PRIORITY_MENU)
         await state.clear()
     except Exception as e:
         logging.error(f'Error in play_poker for {user_id}: {e}')
@@ -2141,17 +4688,19 @@ async def accept_duel(callback: CallbackQuery, state: FSMContext):
     if initiator_id in pending_duels:
         duel_data = pending_duels[initiator_id]
         if duel_data['opp'] == opp_id and duel_data['bet'] == bet:
-            del pending_duels[initiator_id]
-            update_balance(initiator_id, -bet)
-            update_balance(opp_id, -bet)
+            if not try_debit_many(((initiator_id, bet), (opp_id, bet)), game='duel'):
+                # Keep the invite: it can be accepted once both players can cover the stake
+                await callback.answer('У одного из игроков недостаточно баланса!')
+                return
+            remove_duel(initiator_id)
             stats['total_bets'] += bet * 2
             duel_id = f"{min(initiator_id, opp_id)}_{max(initiator_id, opp_id)}"
             chat_id_final = duel_data.get('chat_id') or chat_id
-            pending_duels[duel_id] = {
+            start_duel(duel_id, {
                 'player1': initiator_id, 'player2': opp_id, 'bet': bet, 'mode': duel_data.get('mode', 'slots'), 'chat_id': chat_id_final,
                 'scores': {initiator_id: 0, opp_id: 0}, 'current_turn': initiator_id
-            }
-            save_data()
+            })
+            persistence.mark_dirty('pending_duels')
             mode = duel_data.get('mode', 'slots')
             mode_text = {'slots': 'крутить слоты', 'roulette': 'выбрать в рулетке', 'coin': 'бросить монетку'}.get(mode, 'играть')
             await callback.message.edit_text(f'⚔️ Дуэль ({mode}) принята! Ставка: ${bet}')
@@ -2180,6 +4729,7 @@ async def accept_duel(callback: CallbackQuery, state: FSMContext):
 # Unified duel turn handler (replaces random1/2, initiator/opp)
 @dp.callback_query(F.data.startswith('duel_turn_'))
 async def duel_turn_handler(callback: CallbackQuery):
+    # The update scheduler holds both players' user_locks for duel callbacks, so turns never overlap
     duel_id = callback.data.split('_', 2)[2]
     if duel_id not in pending_duels:
         await callback.answer('Дуэль не найдена!')
@@ -2216,7 +4766,7 @@ async def duel_turn_handler(callback: CallbackQuery):
         score = 1 if choice == outcome else 0
         result_text = f"Монетка: {choice}, Выпало: {outcome} (счёт {score})"
     duel_data['scores'][user_id] = score
-    save_data()
+    persistence.mark_dirty('pending_duels')
     my_score = score
     opp_score = duel_data['scores'][opp_id]
     opp_name = get_opponent_name(opp_id)
@@ -2229,11 +4779,11 @@ async def duel_turn_handler(callback: CallbackQuery):
         await callback.message.edit_text(text)
     if opp_score > 0:
         await end_duel_unified(duel_id, duel_data, user_id, opp_id, bet)
-        del pending_duels[duel_id]
-        save_data()
+        remove_duel(duel_id)
+        persistence.mark_dirty('pending_duels')
         return
     duel_data['current_turn'] = opp_id
-    save_data()
+    persistence.mark_dirty('pending_duels')
     mode_text = {'slots': 'крутить', 'roulette': 'выбрать', 'coin': 'бросить'}.get(mode, 'играть')
     text_opp = f"⚔️ Ваша очередь ({mode_text}), @{my_name}! Ставка: ${bet}\nСчёт: Вы {opp_score} - Оппонент {my_score}"
     keyboard_opp = InlineKeyboardMarkup(inline_keyboard=[
@@ -2260,8 +4810,8 @@ async def end_duel_unified(duel_id, duel_data, last_player, opp_id, bet):
         winner = duel_data['player2']
         loser = duel_data['player1']
     else:
-        update_balance(duel_data['player1'], bet)
-        update_balance(duel_data['player2'], bet)
+        update_balance(duel_data['player1'], bet, game='duel')
+        update_balance(duel_data['player2'], bet, game='duel')
         winner_name = get_opponent_name(duel_data['player1'])
         loser_name = get_opponent_name(duel_data['player2'])
         result_text = f"⚔️ Ничья в дуэли ({mode}) между @{winner_name} и @{loser_name}! Ставка возвращена."
@@ -2272,9 +4822,9 @@ async def end_duel_unified(duel_id, duel_data, last_player, opp_id, bet):
             await bot.send_message(duel_data['player2'], f"⚔️ Ничья ({mode})! +${bet}")
         return
     win_amount = bet * 2
-    update_balance(winner, win_amount)
+    update_balance(winner, win_amount, game='duel')
     stats['total_wins'] += win_amount
-    save_data()
+    persistence.mark_dirty('stats')
     winner_name = get_opponent_name(winner)
     loser_name = get_opponent_name(loser)
     result_text = f"⚔️ @{winner_name} выиграл дуэль ({mode}) против @{loser_name}! +${win_amount}"
@@ -2316,29 +4866,114 @@ async def poker_menu_callback(callback: CallbackQuery, state: FSMContext):
         logging.error(f'Error answering poker menu callback for {user_id}: {e}')
 
 
+# Webhook mode: Telegram (or a reverse proxy in front of the bot) POSTs updates to WEBHOOK_PATH
+BOT_MODE = os.getenv('BOT_MODE', 'polling')  # polling | webhook
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # public https URL, registered with setWebhook on start when set
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))  # concurrent requests Telegram may open
+webhook_rejected = metrics.register(CounterMetric('depbot_webhook_rejected_total', 'Webhook requests refused', ('reason',)))
+
+class WebhookReceiver:
+    """Checks the secret, parses the update and feeds it to dp inline.
+
+    Concurrency and backpressure come from the update scheduler: feed_update returns once
+    the update is queued, and waits while the scheduler is full, so Telegram sees slower
+    responses and holds back.
+    """
+
+    def __init__(self, secret):
+        self.secret = secret.encode()
+
+    async def handle(self, request):
+        if self.secret:
+            token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '').encode()
+            if not hmac.compare_digest(token, self.secret):
+                webhook_rejected.inc('secret')
+                return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={'bot': bot})
+        except ValueError as e:
+            webhook_rejected.inc('invalid')
+            logging.warning(f'Invalid webhook update from {request.remote}: {e}')
+            return web.Response(status=400)
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logging.error(f'Error processing webhook update {update.update_id}: {e}')
+        return web.Response()
+
+webhook = WebhookReceiver(WEBHOOK_SECRET)
+webhook_app = web.Application()
+webhook_app.router.add_post(WEBHOOK_PATH, webhook.handle)
+
+async def run_webhook():
+    """Serve webhook_app until SIGINT/SIGTERM"""
+    webhook_runner = web.AppRunner(webhook_app, access_log=None)
+    await webhook_runner.setup()
+    await web.TCPSite(webhook_runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    if not WEBHOOK_SECRET:
+        logging.warning('WEBHOOK_SECRET is not set: webhook requests are not authenticated')
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, AttributeError):
+            pass
+    try:
+        if WEBHOOK_URL:
+            await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None,
+                                  allowed_updates=dp.resolve_used_update_types(), max_connections=WEBHOOK_MAX_CONNECTIONS)
+        logging.info(f'Webhook listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}')
+        await dp.emit_startup(bot=bot)
+        await stop.wait()
+    finally:
+        for site in list(webhook_runner.sites):
+            await site.stop()  # queued updates are drained by main() before the session closes
+        await webhook_runner.cleanup()
+        await dp.emit_shutdown(bot=bot)
+
 async def main():
-    def run_dashboard():
-        app.run(host='0.0.0.0', port=5000, debug=False)
-    
-    dashboard_thread = threading.Thread(target=run_dashboard)
-    dashboard_thread.daemon = True
-    dashboard_thread.start()
-    logging.info('Dashboard started at http://localhost:5000')
-    
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, DASHBOARD_HOST, DASHBOARD_PORT).start()
+    logging.info(f'Dashboard started at http://localhost:{DASHBOARD_PORT}')
+
     try:
-        # Periodic save every 30s
-        async def periodic_save():
-            while True:
-                await asyncio.sleep(30)
-                save_data()
-        asyncio.create_task(periodic_save())
-        await dp.start_polling(bot)
+        # Debounced saves of dirty collections + periodic snapshot of ledger-backed balances
+        persistence_task = asyncio.create_task(persistence.run())
+        admins_task = asyncio.create_task(admin_registry.watch(ADMINS_WATCH_INTERVAL))
+        lag_task = asyncio.create_task(watch_loop_lag())
+        outbound_task = asyncio.create_task(outbound.run())
+        matcher_task = asyncio.create_task(matchmaker.run(start_random_duel, random_duel_timeout))
+        broadcasts.resume()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, admin_registry.reload, True)
+        except (NotImplementedError, AttributeError):
+            pass  # no SIGHUP on Windows
+        if BOT_MODE == 'webhook':
+            await run_webhook()
+        else:
+            # The scheduler runs updates in its own tasks; inline feeding lets it stall polling when full
+            await dp.start_polling(bot, handle_as_tasks=False, close_bot_session=False)
+        persistence_task.cancel()
+        admins_task.cancel()
+        lag_task.cancel()
+        outbound_task.cancel()
+        matcher_task.cancel()
     except KeyboardInterrupt:
         logging.info('Bot stopped by user')
     except Exception as e:
-        logging.error(f'Error in main polling: {e}')
+        logging.error(f'Error in main loop ({BOT_MODE}): {e}')
     finally:
-        save_data()
+        await update_scheduler.drain()
+        await broadcasts.stop()
+        await bot.session.close()
+        await runner.cleanup()
+        shutdown_persistence()
         logging.info('Bot shutdown, final save completed')
 
 if __name__ == '__main__':